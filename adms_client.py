@@ -0,0 +1,487 @@
+# adms_client.py
+#
+# Cliente del protocolo ADMS (iclock): handshake, getrequest, subida de
+# ATTLOG, USERINFO y log diario. Solo depende de LocalDB y config, así que el
+# servicio de sync arranca sin abrir el puerto del sensor, sin pygame y sin Tk;
+# el UART queda solo para el listener de la UI.
+import os
+import time
+import random
+import socket
+import shutil
+import logging
+import threading
+import subprocess
+from datetime import datetime, timedelta
+
+import psutil
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import CONFIG, SN, get_device_sn
+from metrics import METRICS, METRICS_FILE
+
+ADMS_URL = CONFIG["ADMS_URL"]
+TIMEZONE_OFFSET = CONFIG.get("TIMEZONE_OFFSET", -6)
+ATTLOG_BATCH_SIZE = CONFIG.get("ATTLOG_BATCH_SIZE", 200)
+ADMS_CONNECT_TIMEOUT = CONFIG.get("ADMS_CONNECT_TIMEOUT", 5)
+ADMS_READ_TIMEOUT = CONFIG.get("ADMS_READ_TIMEOUT", 15)
+ADMS_UPLOAD_READ_TIMEOUT = CONFIG.get("ADMS_UPLOAD_READ_TIMEOUT", 60)
+ADMS_POOL_SIZE = CONFIG.get("ADMS_POOL_SIZE", 4)
+ADMS_BREAKER_THRESHOLD = CONFIG.get("ADMS_BREAKER_THRESHOLD", 3)
+ADMS_BACKOFF_BASE_SECONDS = CONFIG.get("ADMS_BACKOFF_BASE_SECONDS", 10)
+ADMS_BACKOFF_MAX_SECONDS = CONFIG.get("ADMS_BACKOFF_MAX_SECONDS", 600)
+SYNC_METRICS_FILE = "logs/metrics-sync.json"
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half-open"
+
+
+class ADMSUnavailable(requests.ConnectionError):
+    """El circuit breaker está abierto: la llamada ni siquiera salió."""
+
+
+class CircuitBreaker:
+    """
+    Decide si ADMS está alcanzable a partir de las llamadas reales (no de un
+    ping a internet). Tras `threshold` fallas seguidas (sin respuesta o 5xx)
+    se abre y rechaza todo hasta retry_at; luego deja pasar una sola llamada
+    de prueba (half-open). Si la prueba responde se cierra; si falla se vuelve
+    a abrir con el doble de espera (con jitter, tope `max_delay`).
+    on_change(state, retry_at, failures) se llama en cada cambio de estado.
+    """
+
+    def __init__(self, threshold=ADMS_BREAKER_THRESHOLD, base_delay=ADMS_BACKOFF_BASE_SECONDS,
+                 max_delay=ADMS_BACKOFF_MAX_SECONDS, on_change=None):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_change = on_change
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.retry_at = 0.0
+        self._opened = 0  # aperturas seguidas: exponente del backoff
+        self._probing = False
+        self._lock = threading.Lock()
+        # on_change escribe en SQLite: corre fuera de _lock, en orden de transición
+        self._publish_lock = threading.Lock()
+        self._changes = 0
+        self._published = 0
+
+    def ready(self):
+        """¿Pasaría una llamada ahora? No consume el turno de prueba."""
+        with self._lock:
+            if self.state == BREAKER_OPEN:
+                return time.time() >= self.retry_at
+            return self.state == BREAKER_CLOSED or not self._probing
+
+    def allow(self):
+        change = None
+        with self._lock:
+            if self.state == BREAKER_OPEN and time.time() >= self.retry_at:
+                change = self._set(BREAKER_HALF_OPEN)
+            if self.state == BREAKER_CLOSED:
+                allowed = True
+            elif self.state == BREAKER_HALF_OPEN and not self._probing:
+                self._probing = True
+                allowed = True
+            else:
+                allowed = False
+        self._publish(change)
+        return allowed
+
+    def record_success(self):
+        change = None
+        with self._lock:
+            self.failures = 0
+            self._opened = 0
+            self._probing = False
+            if self.state != BREAKER_CLOSED:
+                self.retry_at = 0.0
+                change = self._set(BREAKER_CLOSED)
+        self._publish(change)
+
+    def record_failure(self):
+        change = None
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == BREAKER_HALF_OPEN or self.failures >= self.threshold:
+                delay = min(self.max_delay, self.base_delay * 2 ** self._opened)
+                self._opened += 1
+                # "Equal jitter": nunca menos de la mitad, para que varias terminales no reintenten juntas
+                self.retry_at = time.time() + delay / 2 + random.uniform(0, delay / 2)
+                change = self._set(BREAKER_OPEN)
+        self._publish(change)
+
+    def _set(self, state):
+        """Cambia de estado con _lock tomado; devuelve lo que hay que pasar a _publish."""
+        previous, self.state = self.state, state
+        if state == BREAKER_OPEN:
+            logging.warning(f"🔌 ADMS circuit {previous} → open after {self.failures} failures; "
+                            f"retry in {self.retry_at - time.time():.0f}s")
+        else:
+            logging.info(f"🔌 ADMS circuit {previous} → {state}")
+        self._changes += 1
+        return self._changes, self.state, self.retry_at, self.failures
+
+    def _publish(self, change):
+        """Llama on_change sin _lock: un write lento no frena allow() en las demás líneas."""
+        if change is None or not self.on_change:
+            return
+        sequence, state, retry_at, failures = change
+        with self._publish_lock:
+            if sequence <= self._published:
+                return  # otro hilo ya publicó una transición más nueva
+            self._published = sequence
+            try:
+                self.on_change(state, retry_at, failures)
+            except Exception:
+                logging.exception("💥 Failed to publish ADMS circuit state")
+
+
+class ADMSTransport:
+    """
+    Una sola requests.Session para todas las llamadas ADMS: las conexiones
+    quedan abiertas (keep-alive) y se reutilizan entre ciclos, así cada
+    handshake/getrequest/ATTLOG no paga un TCP (ni TLS) nuevo. Todas las
+    llamadas llevan timeout de conexión y de lectura, y su latencia queda en
+    METRICS como adms.<endpoint> (adms.<endpoint>.failed si no hubo respuesta).
+    Todas pasan por el mismo CircuitBreaker; si está abierto se lanza
+    ADMSUnavailable sin tocar la red.
+    """
+
+    def __init__(self, base_url, connect_timeout=ADMS_CONNECT_TIMEOUT,
+                 read_timeout=ADMS_READ_TIMEOUT, pool_size=ADMS_POOL_SIZE, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "User-Agent": "Mindware_bioterminal",
+            "Accept": "*/*",
+        })
+
+    def request(self, method, path, endpoint, **kwargs):
+        if not self.breaker.allow():
+            raise ADMSUnavailable(f"ADMS circuit {self.breaker.state}; next retry at "
+                                  f"{datetime.fromtimestamp(self.breaker.retry_at):%H:%M:%S}")
+
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        except Exception:
+            METRICS.record(f"adms.{endpoint}.failed", time.monotonic() - start)
+            self.breaker.record_failure()
+            raise
+        METRICS.record(f"adms.{endpoint}", time.monotonic() - start)
+        # Un 4xx prueba que ADMS está vivo; solo la falta de respuesta o un 5xx cuentan como caída
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def get(self, path, endpoint, **kwargs):
+        return self.request("GET", path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        return self.request("POST", path, endpoint, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class ADMSClient:
+    def __init__(self, db, update_callback=None, transport=None):
+        self.db = db
+        self.update_callback = update_callback
+        self.transport = transport or ADMSTransport(ADMS_URL)
+        self.transport.breaker.on_change = self._publish_link_state
+        self._publish_link_state(self.transport.breaker.state, self.transport.breaker.retry_at,
+                                 self.transport.breaker.failures)
+
+    def update_status(self, message):
+        if self.update_callback:
+            self.update_callback(message)
+
+    def _publish_link_state(self, state, retry_at, failures):
+        # La UI lo lee de device_state para el indicador de sync
+        self.db.set_adms_link(state, retry_at, failures)
+
+    def is_reachable(self):
+        return self.transport.breaker.ready()
+
+    def send_handshake(self):
+        try:
+            ip = socket.gethostbyname(socket.gethostname())
+            params = {
+                "SN": SN,
+                "options": "all",
+                "language": "101",
+                "pushver": "3.0.0",
+                "PushOptionsFlag": "1"
+            }
+            r = self.transport.get("/iclock/cdata", "handshake", params=params)
+            response = r.text.strip()
+
+            if r.status_code == 200:
+                logging.info(f"🤝 Handshake successful — Response: {response}")
+            else:
+                logging.warning(f"⚠️ Handshake failed: {r.status_code} - {response}")
+        except requests.RequestException as e:
+            logging.warning(f"📴 Handshake failed: {e}")
+        except Exception as e:
+            logging.exception("💥 Handshake error")
+    
+    def upload_latest_log(self):
+
+        try:
+            # Ensure log folder exists
+            os.makedirs("logs", exist_ok=True)
+
+            today = datetime.now().strftime("%Y-%m-%d")
+            original_log = "logs/webroster.log"
+            renamed_log = f"logs/webroster-{today}.log"
+
+            # Rotate the log file: rename current and create a new one
+            if os.path.exists(original_log):
+                shutil.copy2(original_log, renamed_log)  # make a copy
+                open(original_log, 'w').close()  # clear the original log
+
+            # Latencias por endpoint de este proceso, junto a las etapas de la UI
+            METRICS.log_summary(METRICS.dump(SYNC_METRICS_FILE))
+
+            with open(renamed_log, "rb") as f:
+                files = {"file": (os.path.basename(renamed_log), f)}
+                # Histogramas por etapa que escribe la UI (main.py) y los del sync
+                for field, path in (("metrics", METRICS_FILE), ("sync_metrics", SYNC_METRICS_FILE)):
+                    if os.path.exists(path):
+                        with open(path, "rb") as mf:
+                            name = os.path.basename(path).replace(".json", f"-{today}.json")
+                            files[field] = (name, mf.read(), "application/json")
+
+                logging.info(f"📤 Uploading log file: {renamed_log} to {self.transport.base_url}/iclock/upload-log")
+                response = self.transport.post(
+                    "/iclock/upload-log", "upload_log",
+                    files=files,
+                    data={"sn": get_device_sn()},
+                    timeout=(self.transport.timeout[0], ADMS_UPLOAD_READ_TIMEOUT)
+                )
+
+            if response.status_code == 200:
+                logging.info("✅ Log file uploaded successfully.")
+                # Optional: delete after upload
+                os.remove(renamed_log)
+            else:
+                logging.warning(f"⚠️ Upload failed: {response.status_code} - {response.text}")
+
+        except Exception as e:
+            logging.exception("💥 Exception during log upload")
+
+            
+    def poll_getrequest(self):
+
+        def get_cpu_temp():
+            try:
+                output = os.popen("vcgencmd measure_temp").readline()
+                return float(output.replace("temp=", "").replace("'C\n", ""))
+            except:
+                return -1
+
+        def get_uptime():
+            try:
+                output = os.popen("uptime -p").readline()
+                return output.strip()
+            except:
+                return "unknown"
+
+        def get_disk_usage():
+            total, used, free = shutil.disk_usage("/")
+            return f"{int(used / total * 100)}%"
+
+        def get_memory_usage():
+            mem = psutil.virtual_memory()
+            return f"{int(mem.percent)}%"
+
+        def get_git_version(path="/home/mindware/webroster-bio"):
+            try:
+                return subprocess.check_output(["git", "-C", path, "rev-parse", "--short", "HEAD"]).decode().strip()
+            except:
+                return "unknown"
+            
+        try:
+            now = datetime.utcnow() + timedelta(hours=TIMEZONE_OFFSET)
+            current_time = now.strftime("%Y-%m-%d %H:%M:%S")
+            params = {
+                "SN": SN,
+                "options": "all",
+                "language": "101",
+                "pushver": "3.0.0",
+                "PushOptionsFlag": "1",
+                "ip": socket.gethostbyname(socket.gethostname()),
+                "current_time": current_time,
+                "temp": get_cpu_temp(),
+                "uptime": get_uptime(),
+                "disk": get_disk_usage(),
+                "mem": get_memory_usage(),
+                "gitver": get_git_version()
+            }
+            query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+            path = f"/iclock/getrequest?{query_string}"
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+            logging.info(f"🔄 Polling getrequest: {self.transport.base_url}{path}")
+            response = self.transport.get(path, "getrequest", headers=headers)
+            body = response.text.strip()
+
+            if response.status_code == 200:
+                if body.startswith("C:"):
+                    logging.info("📩 Received commands from getrequest")
+                    self._ingest_userinfo(body)
+                    for line in body.splitlines():
+                        logging.debug(f"📩 Command line: {line}")
+                        if "CONTROL DEVICE 03000000" in line:
+                            logging.warning("🌀 Restart command received from ADMS. Rebooting now.")
+                            self._execute_restart()
+                else:
+                    logging.info("🕊️ No pending commands")
+            else:
+                logging.warning(f"⚠️ getrequest failed: {response.status_code} - {body}")
+        except requests.RequestException as e:
+            logging.warning(f"📴 getrequest failed: {e}")
+        except Exception as e:
+            logging.exception("💥 Error during getrequest polling")
+    
+    # ---------------------------------------------------------------------
+    #  Subida de checadas. La corre la tarea "push" de sync_engine, una a la
+    #  vez. Los eventos pasan por pendiente → en vuelo → sincronizado.
+    # ---------------------------------------------------------------------
+    def release_in_flight_events(self):
+        """Regresa a pendiente lo que una corrida anterior dejó en vuelo; llamar antes de arrancar el motor."""
+        released = self.db.reset_in_flight_events()
+        if released:
+            logging.warning(f"♻️ {released} in-flight events from a previous run returned to pending")
+        return released
+
+    def push_pending_events(self):
+        path = f"/iclock/cdata?SN={SN}&table=ATTLOG"
+        headers = {"Content-Type": "text/plain"}
+
+        # Se envía por páginas ordenadas por id; cada página se marca "en vuelo",
+        # se confirma y se persiste (junto con la marca de agua) antes de la siguiente.
+        high_water_mark = self.db.get_attlog_high_water_mark()
+        pushed = 0
+        failed = False
+
+        while True:
+            logs = self.db.claim_unsynced_attlogs(limit=ATTLOG_BATCH_SIZE, after_id=high_water_mark)
+            if not logs:
+                break
+            ids = [log[0] for log in logs]
+
+            lines = ["ATTLOG"]
+            for log in logs:
+                _, user_id, timestamp = log
+                lines.append(f"{user_id}\t{timestamp}\t0\t0\t0")
+
+            payload = "\n".join(lines)
+
+            try:
+                logging.info(f"🛰️ POSTing {len(logs)} events (after id {high_water_mark}) to: {self.transport.base_url}{path}")
+                logging.debug(f"📦 Payload:\n{payload}")
+
+                response = self.transport.post(path, "attlog", data=payload.encode(), headers=headers)
+                response_text = response.text.strip()
+
+                logging.info(f"✅ Response Code: {response.status_code}")
+                logging.debug(f"📩 Response Body:\n{response_text}")
+
+                if response.status_code != 200:
+                    self.db.release_events(ids)
+                    self.update_status(f"❌ Push failed: {response.status_code} - {response.text}")
+                    failed = True
+                    break
+
+                high_water_mark = logs[-1][0]
+                self.db.mark_events_synced(ids, high_water_mark=high_water_mark)
+                pushed += len(logs)
+
+                # Handle remote commands if returned
+                if response_text.startswith("C:"):
+                    self._ingest_userinfo(response_text)
+
+            except Exception as e:
+                self.db.release_events(ids)
+                self.update_status("📴 Offline: sync failed")
+                logging.warning(f"Sync failed due to: {e}")
+                failed = True
+                break
+
+        if failed:
+            if pushed:
+                logging.info(f"⏸️ Synced {pushed} events before failure; resuming after id {high_water_mark}")
+        elif pushed:
+            self.update_status(f"✅ Synced {pushed} events.")
+        else:
+            self.update_status("☁️ No new events to push.")
+
+    @staticmethod
+    def _parse_userinfo_lines(body):
+        """
+        Recorre el cuerpo completo de comandos una sola vez.
+        Devuelve ({idagente: (idempresa, idoficina, idagente, name)}, parsed, rejected).
+        Si un PIN llega repetido gana la última línea.
+        """
+        users = {}
+        parsed = rejected = 0
+
+        for line in body.splitlines():
+            if "USERINFO" not in line:
+                continue
+            parsed += 1
+            try:
+                # Remove the prefix up to "USERINFO" and split the rest by tabs
+                data_part = line.split("USERINFO", 1)[-1].strip()
+                tokens = dict(token.split("=", 1) for token in data_part.split("\t") if "=" in token)
+
+                idagente = int(tokens.get("PIN", "0").strip())
+                if idagente <= 0:
+                    raise ValueError("missing PIN")
+                name = tokens.get("Name", "").strip()
+                idempresa = int(tokens.get("IDEmpresa", 1))
+                idoficina = int(tokens.get("IDOficina", 1))
+            except ValueError as e:
+                rejected += 1
+                logging.warning(f"⚠️ Rejected USERINFO line ({e}): {line}")
+                continue
+
+            users[idagente] = (idempresa, idoficina, idagente, name)
+
+        return users, parsed, rejected
+
+    def _ingest_userinfo(self, body):
+        """Aplica todas las líneas USERINFO de un cuerpo de comandos en una sola transacción."""
+        try:
+            users, parsed, rejected = self._parse_userinfo_lines(body)
+            changed = self.db.add_users(users.values()) if users else []
+
+            # add_users sube roster_version; la UI lo ve y recarga su caché de identidades
+            if parsed:
+                logging.info(f"👥 USERINFO: {parsed} parsed, {len(changed)} changed, {rejected} rejected")
+            return {"parsed": parsed, "changed": len(changed), "rejected": rejected}
+
+        except Exception as e:
+            logging.exception("💥 Failed to ingest USERINFO commands")
+            return {"parsed": 0, "changed": 0, "rejected": 0}
+
+    def _execute_restart(self):
+        try:
+            logging.info("🔁 Rebooting device...")
+            subprocess.Popen(['sudo', '/sbin/reboot'])
+        except Exception as e:
+            logging.exception("💥 Failed to reboot the device.")
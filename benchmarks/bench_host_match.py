@@ -0,0 +1,83 @@
+"""
+Costo por candidato del segundo nivel de match (huellas solo en el host):
+cada candidato es un send_fpdata (512 B de template por UART al char buffer 2)
+más un compare_templates. Un dedo que no está en ningún lado recorre todos
+los candidatos, así que una checada fallida cuesta ~N × este tiempo.
+
+    python benchmarks/bench_host_match.py --emulator [--baud 57600] [--candidates 50]
+    python benchmarks/bench_host_match.py --port /dev/ttyUSB0 --template-slot 0 --probe-slot 1
+
+Con lector real no se borra nada: se cargan dos templates de dedos distintos,
+el de --probe-slot queda en el char buffer 1 y el de --template-slot se baja
+al host y se vuelve a subir como candidato en cada vuelta.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import serial
+import adafruit_fingerprint as af
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sensor_emulator import SensorEmulator  # noqa: E402
+
+
+def measure(finger, candidate, candidates):
+    samples = []
+    for _ in range(candidates):
+        start = time.perf_counter()
+        finger.send_fpdata(list(candidate), "char", 2)
+        if finger.compare_templates() == af.OK:
+            raise SystemExit("Probe and candidate match; use templates from different fingers")
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port")
+    parser.add_argument("--emulator", action="store_true", help="use sensor_emulator with simulated wire time")
+    parser.add_argument("--baud", type=int, default=57600)
+    parser.add_argument("--template-slot", type=int, default=0)
+    parser.add_argument("--probe-slot", type=int, default=1)
+    parser.add_argument("--candidates", type=int, default=50)
+    parser.add_argument("--host-sizes", default="32,100,300,1000", help="host-only counts to project a miss for")
+    args = parser.parse_args()
+
+    emu = None
+    if args.emulator:
+        emu = SensorEmulator(baudrate=args.baud, simulate_wire=True).start()
+        emu.enroll(args.template_slot, "candidate")
+        emu.enroll(args.probe_slot, "probe")
+        port = emu.port
+    elif args.port:
+        port = args.port
+    else:
+        raise SystemExit("Pass --port or --emulator")
+
+    try:
+        finger = af.Adafruit_Fingerprint(serial.Serial(port, baudrate=args.baud, timeout=2))
+        if finger.load_model(args.template_slot, 1) != af.OK:
+            raise SystemExit("Could not load the candidate slot")
+        candidate = bytes(finger.get_fpdata("char", 1))
+        if finger.load_model(args.probe_slot, 1) != af.OK:
+            raise SystemExit("Could not load the probe slot")
+
+        samples = measure(finger, candidate, args.candidates)
+    finally:
+        if emu:
+            emu.stop()
+
+    per_candidate = statistics.median(samples)
+    print(f"baud={args.baud} template={len(candidate)} B "
+          f"per candidate p50={per_candidate:.1f} ms max={max(samples):.1f} ms")
+    print(f"{'host-only':>10} {'miss s':>8}")
+    for n in (int(x) for x in args.host_sizes.split(",")):
+        print(f"{n:>10} {n * per_candidate / 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Mide el listener y el enrolamiento contra sensor_emulator (sin lector físico):
+latencia desde que el dedo toca el lector hasta que la checada queda en la
+base, con la librería del emulador llena al porcentaje indicado, para cada
+SENSOR_SEARCH_MODE.
+
+    python benchmarks/bench_listener.py [--scans 5] [--library-size 200] [--fill 50]
+                                        [--latency-scale 1.0] [--simulate-wire]
+
+Cada modo corre en un directorio temporal con una attendance.db nueva. El
+listener espera 3 s después de cada checada, así que cada escaneo cuesta ~3 s.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import fingerprint_manager as fm  # noqa: E402
+from sensor_emulator import SensorEmulator, finger_template  # noqa: E402
+
+
+def build_manager(emu, agents):
+    manager = fm.FingerprintManager(port=emu.port)
+    for slot, idagente in enumerate(agents):
+        manager.db.add_user(1, 1, idagente, f"Agent {idagente}")
+        emu.enroll(slot, f"finger-{idagente}")
+        manager.db.add_fingerprint(idagente, slot, finger_template(f"finger-{idagente}"))
+    manager.reload_identity_cache()
+    return manager
+
+
+def measure_scans(manager, emu, agents, scans):
+    flushed = threading.Event()
+    manager.refresh_history = flushed.set
+    manager.start_fingerprint_listener()
+    time.sleep(0.5)
+
+    latencies = []
+    # Los agentes del final de la librería son el peor caso para una búsqueda lineal
+    for idagente in list(reversed(agents))[:scans]:
+        flushed.clear()
+        pressed_at = time.monotonic()
+        emu.press(f"finger-{idagente}", duration=0.4)
+        if flushed.wait(timeout=10):
+            latencies.append((time.monotonic() - pressed_at) * 1000)
+        time.sleep(3.2)  # pausa del listener tras una checada
+
+    manager.stop_fingerprint_listener()
+    return latencies
+
+
+def measure_enrollment(manager, emu, idagente):
+    manager.db.add_user(1, 1, idagente, f"Agent {idagente}")
+    done = threading.Event()
+
+    def on_update(message):
+        if message.startswith("✅") or "reintente" in message or "Error" in message:
+            done.set()
+
+    start = time.monotonic()
+    manager.enroll_new_fingerprint_for_user(idagente, "bench", on_update=on_update)
+    emu.press(f"finger-{idagente}", duration=0.3, delay=0.05)
+    emu.press(f"finger-{idagente}", duration=0.3, delay=0.6)
+    done.wait(timeout=10)
+    return (time.monotonic() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scans", type=int, default=5)
+    parser.add_argument("--library-size", type=int, default=200)
+    parser.add_argument("--fill", type=int, default=50, help="percent of the library enrolled")
+    parser.add_argument("--modes", default="full,range,fast")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--simulate-wire", action="store_true")
+    args = parser.parse_args()
+
+    used = max(1, args.library_size * args.fill // 100)
+    agents = [1000 + i for i in range(used)]
+    print(f"library {used}/{args.library_size} slots, {args.scans} scans per mode")
+    print(f"{'mode':>6} {'p50 ms':>8} {'max ms':>8} {'enroll ms':>10}")
+
+    for mode in args.modes.split(","):
+        fm.SENSOR_SEARCH_MODE = mode
+        with tempfile.TemporaryDirectory() as tmp, SensorEmulator(
+                args.library_size, latency_scale=args.latency_scale,
+                simulate_wire=args.simulate_wire) as emu:
+            os.chdir(tmp)
+            manager = build_manager(emu, agents)
+            try:
+                latencies = measure_scans(manager, emu, agents, args.scans)
+                enroll_ms = measure_enrollment(manager, emu, 9999)
+            finally:
+                manager.shutdown()
+                manager.db.close()
+                os.chdir(ROOT)
+        if latencies:
+            print(f"{mode:>6} {statistics.median(latencies):>8.1f} {max(latencies):>8.1f} {enroll_ms:>10.1f}")
+        else:
+            print(f"{mode:>6} {'-':>8} {'-':>8} {enroll_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Mide cuánto cuesta el tráfico UART con el sensor a cada velocidad: la secuencia
+de comandos de un match (get_image → image_2_tz → finger_search) y la
+transferencia de un template al host (load_model + get_fpdata).
+
+    python benchmarks/bench_sensor_baud.py --emulator [--iterations 20]
+    python benchmarks/bench_sensor_baud.py --port /dev/ttyUSB0 [--slot 0] [--iterations 20]
+
+Con --emulator hay un dedo (sin registrar) puesto todo el tiempo y los bytes
+tardan lo que tardarían en el cable; los tiempos de captura y búsqueda son
+los del modelo R307 de sensor_emulator. La columna (wire) es el cálculo
+teórico 8N1 a partir del tamaño de los paquetes, como referencia.
+
+Con lector real, sin dedo los comandos de match responden con error, pero el
+tamaño de los paquetes (y por lo tanto el tiempo en el cable) es el mismo.
+Al terminar el sensor se deja en la velocidad en la que se encontró.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import serial
+import adafruit_fingerprint as af
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fingerprint_manager import BAUD_PARAM, SENSOR_BAUD_RATES  # noqa: E402
+from sensor_emulator import SensorEmulator  # noqa: E402
+
+# Bytes en el cable por operación (comando + ACK + paquetes de datos de 128 B)
+MATCH_BYTES = (12 + 12) + (13 + 12) + (12 + 28) + (17 + 16)
+TEMPLATE_BYTES = (13 + 12) + (13 + 12) + 4 * (128 + 11)
+
+
+def wire_ms(nbytes, baud):
+    return nbytes * 10 / baud * 1000  # 8N1 = 10 bits por byte
+
+
+def find_rate(port):
+    for baud in [57600] + [b for b in reversed(SENSOR_BAUD_RATES) if b != 57600]:
+        uart = serial.Serial(port, baudrate=baud, timeout=0.3)
+        try:
+            finger = af.Adafruit_Fingerprint(uart)
+            uart.timeout = 1
+            return uart, finger
+        except Exception:
+            uart.close()
+    raise SystemExit("Sensor not responding at any baud rate")
+
+
+def switch(uart, finger, baud):
+    finger.set_sysparam(BAUD_PARAM, baud // 9600)
+    uart.baudrate = baud
+    finger.verify_password()
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port")
+    parser.add_argument("--emulator", action="store_true", help="use sensor_emulator with simulated wire time")
+    parser.add_argument("--rates", default="57600,115200")
+    parser.add_argument("--slot", type=int, default=0, help="slot with a stored template")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    emu = None
+    if args.emulator:
+        emu = SensorEmulator(simulate_wire=True).start()
+        emu.enroll(args.slot, "stored")
+        emu.press("unknown", duration=24 * 3600)
+        port = emu.port
+    elif args.port:
+        port = args.port
+    else:
+        raise SystemExit("Pass --port or --emulator")
+
+    uart, finger = find_rate(port)
+    original = uart.baudrate
+
+    def match():
+        finger.get_image()
+        finger.image_2_tz(1)
+        finger.finger_search()
+
+    def transfer():
+        finger.load_model(args.slot, 1)
+        finger.get_fpdata("char", 1)
+
+    print(f"{'baud':>8} {'match ms':>10} {'(wire)':>8} {'template ms':>12} {'(wire)':>8}")
+    try:
+        for baud in (int(b) for b in args.rates.split(",")):
+            switch(uart, finger, baud)
+            match_ms = timed(match, args.iterations)
+            transfer_ms = timed(transfer, args.iterations)
+            print(f"{baud:>8} {match_ms:>10.1f} {wire_ms(MATCH_BYTES, baud):>8.1f} "
+                  f"{transfer_ms:>12.1f} {wire_ms(TEMPLATE_BYTES, baud):>8.1f}")
+    finally:
+        switch(uart, finger, original)
+        uart.close()
+        if emu:
+            emu.stop()
+
+
+if __name__ == "__main__":
+    main()
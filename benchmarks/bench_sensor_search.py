@@ -0,0 +1,107 @@
+"""
+Compara finger_search() de la librería (read_sysparam + búsqueda sobre toda la
+capacidad) contra la búsqueda limitada al tramo ocupado (search_slot_range),
+con la librería llena al 10 %, 50 % y 100 %.
+
+    python benchmarks/bench_sensor_search.py --emulator [--library-size 1000] [--baud 57600]
+    python benchmarks/bench_sensor_search.py --port /dev/ttyUSB0 \\
+        --template-slot 0 --probe-slot 1 --scratch [--baud 57600] [--iterations 10]
+
+Con --emulator los tiempos del módulo son los de sensor_emulator (R307
+aproximado, más el tiempo de los bytes en el cable); sirven para comparar los
+modos entre sí, no como cifra absoluta de un lector.
+
+Con lector real BORRA la librería del sensor: usar solo uno de pruebas. Se necesitan
+dos templates de dedos distintos ya guardados; el de --template-slot se copia
+en los slots de relleno y el de --probe-slot se busca sin que haya match, que
+es el peor caso (se recorre todo el tramo).
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import serial
+import adafruit_fingerprint as af
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fingerprint_manager import search_slot_range  # noqa: E402
+from sensor_emulator import SensorEmulator  # noqa: E402
+
+# read_sysparam que se ahorra cada búsqueda: comando (12 B) + respuesta (28 B)
+SYSPARAM_BYTES = 12 + 28
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port")
+    parser.add_argument("--emulator", action="store_true", help="use sensor_emulator with simulated wire time")
+    parser.add_argument("--library-size", type=int, default=1000, help="emulated library capacity")
+    parser.add_argument("--baud", type=int, default=57600)
+    parser.add_argument("--template-slot", type=int, default=0, help="template used to fill the library")
+    parser.add_argument("--probe-slot", type=int, default=1, help="template from a different finger to search for")
+    parser.add_argument("--fills", default="10,50,100", help="library fill percentages")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--scratch", action="store_true", help="confirm the sensor library may be erased")
+    args = parser.parse_args()
+
+    emu = None
+    if args.emulator:
+        emu = SensorEmulator(library_size=args.library_size, baudrate=args.baud, simulate_wire=True).start()
+        emu.enroll(args.template_slot, "filler")
+        emu.enroll(args.probe_slot, "probe")
+        port = emu.port
+    elif not args.port:
+        raise SystemExit("Pass --port or --emulator")
+    elif not args.scratch:
+        raise SystemExit("This benchmark erases the sensor library; pass --scratch on a test reader")
+    else:
+        port = args.port
+
+    uart = serial.Serial(port, baudrate=args.baud, timeout=5)
+    finger = af.Adafruit_Fingerprint(uart)
+    capacity = finger.library_size
+
+    # Char buffer 1 = probe, char buffer 2 = relleno; ambos se cargan antes de vaciar la librería
+    if finger.load_model(args.probe_slot, 1) != af.OK or finger.load_model(args.template_slot, 2) != af.OK:
+        raise SystemExit("Could not load the template/probe slots")
+    finger.empty_library()
+
+    print(f"capacity={capacity} baud={args.baud} "
+          f"(read_sysparam on the wire: {SYSPARAM_BYTES * 10 / args.baud * 1000:.1f} ms)")
+    print(f"{'fill':>5} {'slots':>6} {'full ms':>9} {'range ms':>9} {'fast ms':>9} {'saved':>7}")
+
+    filled = 0
+    try:
+        for pct in (int(p) for p in args.fills.split(",")):
+            used = max(1, capacity * pct // 100)
+            for slot in range(filled, used):
+                if finger.store_model(slot, 2) != af.OK:
+                    raise SystemExit(f"Could not store filler template in slot {slot}")
+            filled = used
+
+            full_ms = timed(finger.finger_search, args.iterations)
+            range_ms = timed(lambda: search_slot_range(finger, 0, used), args.iterations)
+            fast_ms = timed(lambda: search_slot_range(finger, 0, used, fast=True), args.iterations)
+            print(f"{pct:>4}% {used:>6} {full_ms:>9.1f} {range_ms:>9.1f} {fast_ms:>9.1f} "
+                  f"{(1 - range_ms / full_ms) * 100:>6.0f}%")
+    finally:
+        finger.empty_library()
+        uart.close()
+        if emu:
+            emu.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compara el acuse de sincronización por evento (mark_event_synced) contra el
+acuse por lotes (mark_events_synced) sobre una base temporal.
+
+    python benchmarks/bench_sync_ack.py [--events 10000] [--synchronous NORMAL]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from db import LocalDB  # noqa: E402
+
+
+def seed_events(db, count):
+    with db.lock:
+        db.conn.executemany(
+            'INSERT INTO events (user_id, timestamp, type) VALUES (?, ?, ?)',
+            ((1000 + i % 50, "2025-01-15T07:32:00", "checkin") for i in range(count))
+        )
+        db.conn.commit()
+    return [row[0] for row in db.reader.execute('SELECT id FROM events WHERE synced = 0')]
+
+
+def run(events, synchronous):
+    results = {}
+    for label in ("per-row", "batched"):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = LocalDB(os.path.join(tmp, "bench.db"), synchronous=synchronous)
+            ids = seed_events(db, events)
+
+            start = time.perf_counter()
+            if label == "per-row":
+                for event_id in ids:
+                    db.mark_event_synced(event_id)
+            else:
+                db.mark_events_synced(ids)
+            elapsed = time.perf_counter() - start
+
+            pending = db.reader.execute('SELECT COUNT(*) FROM events WHERE synced = 0').fetchone()[0]
+            assert pending == 0, f"{label}: {pending} events left unsynced"
+            db.close()
+        results[label] = elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--synchronous", default="NORMAL")
+    args = parser.parse_args()
+
+    results = run(args.events, args.synchronous)
+    print(f"{args.events} events, synchronous={args.synchronous}")
+    for label, elapsed in results.items():
+        print(f"  {label:8s} {elapsed * 1000:10.1f} ms  ({elapsed / args.events * 1e6:8.1f} µs/event)")
+    print(f"  speedup  {results['per-row'] / results['batched']:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
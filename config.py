@@ -0,0 +1,22 @@
+# config.py
+#
+# config.json y el número de serie del equipo. Lo comparten la UI
+# (main.py, fingerprint_manager.py) y el servicio de sync sin arrastrar el
+# sensor, pygame ni Tk.
+import json
+import os
+
+with open(os.path.join(os.path.dirname(__file__), "config.json")) as f:
+    CONFIG = json.load(f)
+
+def get_device_sn(prefix="WBIO"):
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('Serial'):
+                    serial = line.strip().split(":")[1].strip()
+                    return f"{prefix}{serial[-6:].upper()}"
+    except Exception as e:
+        return f"{prefix}000000"
+
+SN = get_device_sn(CONFIG.get("SN_PREFIX", "WBIO"))
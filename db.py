@@ -1,68 +1,376 @@
+import os
 import sqlite3
-from datetime import datetime
+import hashlib
+import logging
+import queue
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 import threading
+import weakref
+from metrics import METRICS
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+MAX_SQL_VARIABLES = 500
+
+
+def _id_runs(ids):
+    """Agrupa ids ordenados en tramos contiguos [(inicio, fin), ...]."""
+    runs = []
+    for i in ids:
+        if runs and i == runs[-1][1] + 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
+
+def local_datetime(ts_epoch, utc_offset):
+    """Fecha/hora local (naive) de un evento a partir de su epoch y su offset en minutos."""
+    return datetime.fromtimestamp(ts_epoch, timezone.utc).replace(tzinfo=None) + timedelta(minutes=utc_offset or 0)
+
+
+def user_content_hash(idempresa, idoficina, name):
+    """Huella del contenido de un usuario tal como lo manda el servidor."""
+    payload = f"{int(idempresa)}\t{int(idoficina)}\t{name or ''}"
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+# ---------------------------------------------------------------------
+#  Migraciones de esquema: (versión, descripción, función(cursor, db)).
+#  Nunca se edita una migración ya publicada; siempre se agrega una nueva.
+# ---------------------------------------------------------------------
+def _migration_base_tables(c, db):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            idempresa INTEGER,
+            idoficina INTEGER,
+            idagente INTEGER PRIMARY KEY,
+            name TEXT,
+            enrolled_at TEXT
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idagente INTEGER,
+            finger_id INTEGER,
+            FOREIGN KEY (idagente) REFERENCES users(idagente)
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            timestamp TEXT,
+            type TEXT,
+            synced INTEGER DEFAULT 0
+        )
+    ''')
+
+
+def _migration_hot_path_indexes(c, db):
+    # Parcial y cubriente: solo contiene los pendientes, la consulta de sync no toca la tabla
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_events_unsynced
+        ON events (id, user_id, timestamp, synced) WHERE synced = 0
+    ''')
+    # Cubriente para el match: finger_id → idagente sin leer la tabla
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fingerprints_finger_id ON fingerprints (finger_id, idagente)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fingerprints_idagente ON fingerprints (idagente, finger_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events (timestamp, user_id)')
+
+
+def _migration_device_state(c, db):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS device_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def _migration_user_content_hash(c, db):
+    columns = [row[1] for row in c.execute("PRAGMA table_info(users)")]
+    if "content_hash" not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN content_hash TEXT")
+
+
+def _migration_event_epoch(c, db):
+    # Los timestamps ISO existentes son hora local de la terminal; se convierten
+    # a epoch UTC con el offset configurado y se conservan tal cual en texto.
+    columns = [row[1] for row in c.execute("PRAGMA table_info(events)")]
+    if "ts_epoch" not in columns:
+        c.execute("ALTER TABLE events ADD COLUMN ts_epoch INTEGER")
+    if "utc_offset" not in columns:
+        c.execute("ALTER TABLE events ADD COLUMN utc_offset INTEGER")
+    c.execute(
+        '''
+        UPDATE events
+        SET ts_epoch = CAST(strftime('%s', timestamp) AS INTEGER) - ? * 60,
+            utc_offset = ?
+        WHERE ts_epoch IS NULL
+        ''',
+        (db.utc_offset_minutes, db.utc_offset_minutes)
+    )
+    c.execute('DROP INDEX IF EXISTS idx_events_timestamp')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_events_ts_epoch ON events (ts_epoch)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_events_user_ts ON events (user_id, ts_epoch)')
+
+
+def _migration_host_templates(c, db):
+    # Template de cada huella guardado en el host; finger_id NULL = no está en el sensor
+    columns = [row[1] for row in c.execute("PRAGMA table_info(fingerprints)")]
+    if "template" not in columns:
+        c.execute("ALTER TABLE fingerprints ADD COLUMN template BLOB")
+
+
+def _migration_fingerprint_enrolled_epoch(c, db):
+    # Cuándo se guardó la huella: un agente recién enrolado (sin checadas) no es el "menos usado".
+    # Las filas existentes toman el enrolled_at (hora local ISO) de su usuario.
+    columns = [row[1] for row in c.execute("PRAGMA table_info(fingerprints)")]
+    if "enrolled_epoch" not in columns:
+        c.execute("ALTER TABLE fingerprints ADD COLUMN enrolled_epoch INTEGER")
+    c.execute(
+        '''
+        UPDATE fingerprints
+        SET enrolled_epoch = (
+            SELECT CAST(strftime('%s', u.enrolled_at) AS INTEGER) - ? * 60
+            FROM users u WHERE u.idagente = fingerprints.idagente
+        )
+        WHERE enrolled_epoch IS NULL
+        ''',
+        (db.utc_offset_minutes,)
+    )
+
+
+MIGRATIONS = [
+    (1, "base tables", _migration_base_tables),
+    (2, "hot-path indexes", _migration_hot_path_indexes),
+    (3, "device_state key/value table", _migration_device_state),
+    (4, "users.content_hash", _migration_user_content_hash),
+    (5, "integer epoch event timestamps", _migration_event_epoch),
+    (6, "host-side fingerprint templates", _migration_host_templates),
+    (7, "fingerprints.enrolled_epoch", _migration_fingerprint_enrolled_epoch),
+]
+
+# Estados de events.synced
+EVENT_PENDING = 0
+EVENT_SYNCED = 1
+EVENT_IN_FLIGHT = 2
+
+ATTLOG_HWM_KEY = "attlog_high_water_mark"
+ARCHIVE_FILE_PREFIX = "events-"
+SLOT_BITMAP_KEY = "slot_bitmap"
+SLOT_CAPACITY_KEY = "slot_capacity"
+ADMS_LINK_KEY = "adms_link"
+ROSTER_VERSION_KEY = "roster_version"
+ARCHIVE_BATCH_ROWS = 1000   # filas por transacción al archivar
+VACUUM_BATCH_PAGES = 256    # páginas por transacción en el vacuum incremental
+MAINTENANCE_BATCH_PAUSE = 0.05  # segundos entre lotes, ver _checkpoint_between_batches
+DEFAULT_SLOT_CAPACITY = 128  # slots 0..127, el límite que se usaba antes de leer el sensor
+
+
+class _ReaderHolder:
+    """Conexión de lectura de un hilo; al recolectarse junto con el threading.local del hilo, se cierra."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+def _close_reader(conn, readers, lock):
+    with lock:
+        readers.discard(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
 class LocalDB:
-    def __init__(self, db_path="attendance.db"):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+    def __init__(self, db_path="attendance.db", synchronous="NORMAL", busy_timeout_ms=5000,
+                 utc_offset_hours=0):
+        """
+        db_path          →  Archivo SQLite de la terminal.
+        utc_offset_hours →  Offset local de la terminal (TIMEZONE_OFFSET); se guarda con cada evento.
+        synchronous      →  PRAGMA synchronous (NORMAL es seguro con WAL y evita un fsync por commit).
+        busy_timeout_ms  →  Espera máxima ante un lock antes de lanzar "database is locked".
+
+        Una sola conexión escritora (self.conn, protegida por self.lock) y una
+        conexión de solo lectura por hilo (self.reader). Con WAL los lectores
+        nunca esperan al escritor.
+        """
+        synchronous = str(synchronous).upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid synchronous mode: {synchronous}")
+
+        self.db_path = db_path
+        self.synchronous = synchronous
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.utc_offset_minutes = int(round(float(utc_offset_hours) * 60))
         self.lock = threading.Lock()
-        self.create_tables()
+        self._local = threading.local()
+        self._readers = set()
+        self._readers_lock = threading.Lock()
 
+        self.conn = self._connect()
+        # Solo surte efecto en una base nueva (sin tablas); una existente exigiría un VACUUM completo
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.run_migrations()
+        self._load_slot_bitmap()
 
-    def create_tables(self):
+    def _connect(self, read_only=False):
+        if read_only:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   timeout=self.busy_timeout_ms / 1000)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   timeout=self.busy_timeout_ms / 1000)
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        return conn
+
+    @property
+    def reader(self):
+        """Conexión de solo lectura propia del hilo que llama; se cierra cuando el hilo termina."""
+        holder = getattr(self._local, "reader", None)
+        if holder is None:
+            holder = _ReaderHolder(self._connect(read_only=True))
+            with self._readers_lock:
+                self._readers.add(holder.conn)
+            # threading.local suelta el holder al morir el hilo: ahí se cierra la conexión
+            weakref.finalize(holder, _close_reader, holder.conn, self._readers, self._readers_lock)
+            self._local.reader = holder
+        return holder.conn
+
+    def close(self):
+        with self._readers_lock:
+            readers = list(self._readers)
+        for conn in readers:
+            _close_reader(conn, self._readers, self._readers_lock)
         with self.lock:
-            c = self.conn.cursor()
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    idempresa INTEGER,
-                    idoficina INTEGER,
-                    idagente INTEGER PRIMARY KEY,
-                    name TEXT,
-                    enrolled_at TEXT
-                )
-            ''')
+            self.conn.close()
 
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS fingerprints (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    idagente INTEGER,
-                    finger_id INTEGER,
-                    FOREIGN KEY (idagente) REFERENCES users(idagente)
-                )
-            ''')
 
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS events (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    timestamp TEXT,
-                    type TEXT,
-                    synced INTEGER DEFAULT 0
+    def run_migrations(self):
+        """
+        Aplica en orden las migraciones pendientes de MIGRATIONS.
+        Cada una corre en su propia transacción (BEGIN IMMEDIATE) junto con el
+        registro en schema_version, así una base existente en campo se actualiza
+        sin perder datos y dos procesos (UI y sync) no la aplican dos veces.
+        """
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TEXT
                 )
             ''')
             self.conn.commit()
 
+            for version, description, migrate in MIGRATIONS:
+                c = self.conn.cursor()
+                try:
+                    c.execute("BEGIN IMMEDIATE")
+                    current = c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+                    if version <= current:
+                        self.conn.commit()
+                        continue
+                    migrate(c, self)
+                    c.execute(
+                        'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                        (version, description, datetime.now().isoformat())
+                    )
+                    self.conn.commit()
+                    logging.info(f"🗄️ Schema migrated to v{version}: {description}")
+                except Exception:
+                    self.conn.rollback()
+                    logging.exception(f"💥 Schema migration v{version} failed")
+                    raise
+
+    def schema_version(self):
+        c = self.reader.cursor()
+        c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return c.fetchone()[0]
+
     def add_user(self, idempresa, idoficina, idagente, name=""):
+        return bool(self.add_users([(idempresa, idoficina, idagente, name)]))
+
+    def add_users(self, users):
+        """
+        Upsert de [(idempresa, idoficina, idagente, name), ...] con un solo
+        executemany/commit. Las filas cuyo content_hash no cambió se omiten (no
+        se escribe nada si no hubo cambios) y enrolled_at solo se fija al insertar.
+        Devuelve la lista de idagente que realmente cambiaron.
+        """
+        rows = {}
+        for idempresa, idoficina, idagente, name in users:
+            rows[idagente] = (idempresa, idoficina, idagente, name,
+                              user_content_hash(idempresa, idoficina, name))
+        if not rows:
+            return []
+
         with self.lock:
             c = self.conn.cursor()
-            c.execute(
-                'INSERT OR REPLACE INTO users (idempresa, idoficina, idagente, name, enrolled_at) VALUES (?, ?, ?, ?, ?)',
-                (idempresa, idoficina, idagente, name, datetime.now().isoformat())
-            )
-            self.conn.commit()
+            ids = list(rows)
+            current = {}
+            for start in range(0, len(ids), MAX_SQL_VARIABLES):
+                chunk = ids[start:start + MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(chunk))
+                current.update(c.execute(
+                    f'SELECT idagente, content_hash FROM users WHERE idagente IN ({placeholders})', chunk
+                ).fetchall())
 
-    def get_finger_ids_by_user(self, idagente):
-        c = self.conn.cursor()
-        rows = c.execute("SELECT finger_id FROM fingerprints WHERE idagente = ?", (idagente,)).fetchall()
-        return [r[0] for r in rows]
+            changed = [row for idagente, row in rows.items() if current.get(idagente) != row[4]]
+            if not changed:
+                return []
+
+            now = datetime.now().isoformat()
+            try:
+                c.executemany(
+                    '''
+                    INSERT INTO users (idempresa, idoficina, idagente, name, content_hash, enrolled_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(idagente) DO UPDATE SET
+                        idempresa = excluded.idempresa,
+                        idoficina = excluded.idoficina,
+                        name = excluded.name,
+                        content_hash = excluded.content_hash
+                    ''',
+                    [row + (now,) for row in changed]
+                )
+                self._bump_roster_version(c)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            return [row[2] for row in changed]
 
     def count_fingerprints_by_user(self, idagente):
-        c = self.conn.cursor()
+        c = self.reader.cursor()
         c.execute("SELECT COUNT(*) FROM fingerprints WHERE idagente = ?", (idagente,))
         result = c.fetchone()
         return result[0] if result else 0
     
+    def get_users_with_fingerprint_counts(self):
+        """[(idagente, name, fingerprint_count), ...] ordenado por nombre, en una sola consulta."""
+        c = self.reader.cursor()
+        c.execute('''
+            SELECT u.idagente, u.name, COUNT(f.id)
+            FROM users u
+            LEFT JOIN fingerprints f ON f.idagente = u.idagente
+            GROUP BY u.idagente
+            ORDER BY u.name
+        ''')
+        return c.fetchall()
+
     def count_all_fingerprints(self):
-        c = self.conn.cursor()
+        c = self.reader.cursor()
         c.execute("SELECT COUNT(*) FROM fingerprints")
         return c.fetchone()[0]
 
@@ -70,57 +378,290 @@ class LocalDB:
         try:
             self.lock.acquire()
             c = self.conn.cursor()
+            freed = [row[0] for row in c.execute(
+                "SELECT finger_id FROM fingerprints WHERE idagente = ? AND finger_id IS NOT NULL", (idagente,)
+            )]
             c.execute("DELETE FROM fingerprints WHERE idagente = ?", (idagente,))
+            bitmap = self._slot_bitmap
+            for fid in freed:
+                bitmap &= ~(1 << fid)
+            self._set_state(c, SLOT_BITMAP_KEY, format(bitmap, "x"))
+            self._bump_roster_version(c)
             self.conn.commit()
+            self._slot_bitmap = bitmap
         except Exception as e:
+            self.conn.rollback()
             print(f"Error removing fingerprints for user {idagente}: {e}")
         finally:
             self.lock.release()
 
     def get_finger_ids_by_user(self, idagente):
-        return [row[0] for row in self.conn.execute(
-            "SELECT finger_id FROM fingerprints WHERE idagente = ?", (idagente,)
+        """Slots del sensor que ocupa el agente (las huellas solo en el host no cuentan)."""
+        return [row[0] for row in self.reader.execute(
+            "SELECT finger_id FROM fingerprints WHERE idagente = ? AND finger_id IS NOT NULL", (idagente,)
         )]
 
-    def get_next_available_finger_id(self, max_id=127):
-        c = self.conn.cursor()
-        used_ids = c.execute('SELECT finger_id FROM fingerprints').fetchall()
-        used_ids = set(row[0] for row in used_ids)
+    # ---------------------------------------------------------------------
+    #  Asignación de slots del sensor: bitmap de ocupados persistido en
+    #  device_state y reflejado en memoria (bit n = slot n ocupado).
+    # ---------------------------------------------------------------------
+    def _load_slot_bitmap(self):
+        """Carga el bitmap persistido; si no cuadra con la tabla fingerprints se reconstruye."""
+        with self.lock:
+            c = self.conn.cursor()
+            used = [row[0] for row in c.execute('SELECT DISTINCT finger_id FROM fingerprints WHERE finger_id >= 0')]
+            stored = self.get_state(SLOT_BITMAP_KEY)
+            bitmap = int(stored, 16) if stored else 0
+
+            if bitmap.bit_count() != len(used) or any(not bitmap >> fid & 1 for fid in used):
+                if stored is not None:
+                    logging.warning("⚠️ Slot bitmap out of sync with fingerprints table, rebuilding")
+                bitmap = 0
+                for fid in used:
+                    bitmap |= 1 << fid
+                self._set_state(c, SLOT_BITMAP_KEY, format(bitmap, "x"))
+                self.conn.commit()
 
-        for i in range(max_id + 1):
-            if i not in used_ids:
-                return i
+            self._slot_bitmap = bitmap
 
-        raise Exception("No available fingerprint slots")
+            capacity = self.get_state(SLOT_CAPACITY_KEY)
+            self.slot_capacity = int(capacity) if capacity else DEFAULT_SLOT_CAPACITY
 
-    def add_fingerprint(self, idagente, finger_id):
+    def set_slot_capacity(self, capacity):
+        """Tamaño real de la librería del sensor (library_size del read_sysparam)."""
+        capacity = int(capacity)
+        if capacity == self.slot_capacity and self.get_state(SLOT_CAPACITY_KEY):
+            return
+        self.slot_capacity = capacity
+        self.set_state(SLOT_CAPACITY_KEY, capacity)
+
+    def count_used_slots(self):
+        return self._slot_bitmap.bit_count()
+
+    def get_occupied_span(self):
+        """(primer, último) slot ocupado según el bitmap; None si la librería está vacía."""
+        bitmap = self._slot_bitmap
+        if not bitmap:
+            return None
+        return (bitmap & -bitmap).bit_length() - 1, bitmap.bit_length() - 1
+
+    def get_next_available_finger_id(self, max_id=None):
+        """Slot libre más bajo en O(1): el bit más bajo en 0 es ~b & (b + 1)."""
+        limit = self.slot_capacity if max_id is None else max_id + 1
+        bitmap = self._slot_bitmap
+        finger_id = ((~bitmap) & (bitmap + 1)).bit_length() - 1
+
+        if finger_id >= limit:
+            raise Exception("No available fingerprint slots")
+        return finger_id
+
+    def add_fingerprint(self, idagente, finger_id, template=None):
         with self.lock:
             c = self.conn.cursor()
-            c.execute('INSERT INTO fingerprints (idagente, finger_id) VALUES (?, ?)', (idagente, finger_id))
+            try:
+                c.execute(
+                    'INSERT INTO fingerprints (idagente, finger_id, template, enrolled_epoch) VALUES (?, ?, ?, ?)',
+                    (idagente, finger_id, template, int(time.time()))
+                )
+                bitmap = self._slot_bitmap | (1 << finger_id)
+                self._set_state(c, SLOT_BITMAP_KEY, format(bitmap, "x"))
+                self._bump_roster_version(c)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self._slot_bitmap = bitmap
+
+    def move_fingerprint(self, old_finger_id, new_finger_id):
+        """Reasigna el template de un slot a otro (compactación); fila y bitmap en la misma transacción."""
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('UPDATE fingerprints SET finger_id = ? WHERE finger_id = ?', (new_finger_id, old_finger_id))
+                bitmap = (self._slot_bitmap & ~(1 << old_finger_id)) | (1 << new_finger_id)
+                self._set_state(c, SLOT_BITMAP_KEY, format(bitmap, "x"))
+                self._bump_roster_version(c)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self._slot_bitmap = bitmap
+
+    # ---------------------------------------------------------------------
+    #  Store de templates en el host: todas las huellas tienen su template en
+    #  la base; el sensor guarda solo las que caben (las más usadas).
+    # ---------------------------------------------------------------------
+    def save_template(self, finger_id, template):
+        with self.lock:
+            self.conn.execute('UPDATE fingerprints SET template = ? WHERE finger_id = ?', (template, finger_id))
             self.conn.commit()
-    
+
+    def get_slots_missing_template(self):
+        return [row[0] for row in self.reader.execute(
+            'SELECT finger_id FROM fingerprints WHERE finger_id IS NOT NULL AND template IS NULL ORDER BY finger_id'
+        )]
+
+    def get_host_only_templates(self):
+        """
+        [(id, idagente, template), ...] de las huellas que no están cargadas en
+        el sensor, de la última checada más reciente a la más vieja (sin
+        checadas al final, las enroladas más nuevas primero).
+        """
+        return self.reader.execute(
+            '''
+            SELECT f.id, f.idagente, f.template
+            FROM fingerprints f
+            WHERE f.finger_id IS NULL AND f.template IS NOT NULL
+            ORDER BY (SELECT MAX(e.ts_epoch) FROM events e WHERE e.user_id = f.idagente) DESC, f.id DESC
+            '''
+        ).fetchall()
+
+    def get_least_recent_slot(self):
+        """
+        Slot residente cuyo agente lleva más tiempo sin usarlo: lo más reciente
+        entre su última checada (vía idx_events_user_ts) y el enrolamiento de
+        la huella, así un recién enrolado sin checadas no sale primero. Solo se
+        consideran huellas con template en el host, que son las que se pueden
+        sacar del sensor sin perderlas.
+        """
+        row = self.reader.execute(
+            '''
+            SELECT f.finger_id
+            FROM fingerprints f
+            WHERE f.finger_id IS NOT NULL AND f.template IS NOT NULL
+            ORDER BY MAX(
+                COALESCE((SELECT MAX(e.ts_epoch) FROM events e WHERE e.user_id = f.idagente), 0),
+                COALESCE(f.enrolled_epoch, 0)
+            ), f.id
+            LIMIT 1
+            '''
+        ).fetchone()
+        return row[0] if row else None
+
+    def evict_fingerprint(self, finger_id):
+        """La huella deja el sensor pero conserva su template en la base."""
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('UPDATE fingerprints SET finger_id = NULL WHERE finger_id = ?', (finger_id,))
+                bitmap = self._slot_bitmap & ~(1 << finger_id)
+                self._set_state(c, SLOT_BITMAP_KEY, format(bitmap, "x"))
+                self._bump_roster_version(c)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self._slot_bitmap = bitmap
+
+    def promote_fingerprint(self, fingerprint_id, finger_id):
+        """Una huella que solo estaba en el host queda cargada en el slot finger_id."""
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('UPDATE fingerprints SET finger_id = ? WHERE id = ?', (finger_id, fingerprint_id))
+                bitmap = self._slot_bitmap | (1 << finger_id)
+                self._set_state(c, SLOT_BITMAP_KEY, format(bitmap, "x"))
+                self._bump_roster_version(c)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self._slot_bitmap = bitmap
+
     def get_agent_by_finger_id(self, finger_id):
-        c = self.conn.cursor()
+        c = self.reader.cursor()
         c.execute('SELECT idagente FROM fingerprints WHERE finger_id = ?', (finger_id,))
         result = c.fetchone()
         return result[0] if result else None
     
-    def add_event(self, user_id, type='checkin', timestamp=None):
-        if timestamp is None:
-            timestamp = datetime.now().isoformat()
+    def get_identity_map(self):
+        """{finger_id: (idagente, name)} para todos los slots ocupados, en una consulta."""
+        c = self.reader.cursor()
+        c.execute('''
+            SELECT f.finger_id, f.idagente, u.name
+            FROM fingerprints f
+            LEFT JOIN users u ON u.idagente = f.idagente
+            WHERE f.finger_id IS NOT NULL
+        ''')
+        return {fid: (idagente, name) for fid, idagente, name in c.fetchall()}
+
+    def roster_version(self):
+        """Cambia solo cuando cambian usuarios o huellas (no con checadas ni con acks de ATTLOG)."""
+        return int(self.get_state(ROSTER_VERSION_KEY, 0))
+
+    def _event_row(self, user_id, type, ts_epoch, utc_offset):
+        if ts_epoch is None:
+            ts_epoch = int(time.time())
+        if utc_offset is None:
+            utc_offset = self.utc_offset_minutes
+        # El texto ISO local se conserva para el payload ATTLOG
+        timestamp = local_datetime(ts_epoch, utc_offset).isoformat()
+        return (user_id, timestamp, int(ts_epoch), utc_offset, type)
+
+    def add_event(self, user_id, type='checkin', ts_epoch=None, utc_offset=None):
+        self.add_events([(user_id, type, ts_epoch, utc_offset)])
+
+    def add_events(self, events):
+        """Inserta [(user_id, type, ts_epoch, utc_offset), ...] en una sola transacción."""
+        rows = [self._event_row(*event) for event in events]
         with self.lock:
-            c = self.conn.cursor()
-            c.execute('INSERT INTO events (user_id, timestamp, type) VALUES (?, ?, ?)',
-                    (user_id, timestamp, type))
-            self.conn.commit()
+            try:
+                self.conn.executemany(
+                    'INSERT INTO events (user_id, timestamp, ts_epoch, utc_offset, type) VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+    # ---------------------------------------------------------------------
+    #  Consultas por rango de tiempo (usan idx_events_ts_epoch / idx_events_user_ts)
+    #  Filas: (id, user_id, name, ts_epoch, utc_offset, type)
+    # ---------------------------------------------------------------------
+    _EVENT_COLUMNS = '''
+        SELECT e.id, e.user_id, COALESCE(u.name, 'User ' || e.user_id), e.ts_epoch, e.utc_offset, e.type
+        FROM events e
+        LEFT JOIN users u ON u.idagente = e.user_id
+    '''
+
+    def get_recent_events(self, limit=3, idagente=None):
+        c = self.reader.cursor()
+        if idagente is None:
+            c.execute(self._EVENT_COLUMNS + ' ORDER BY e.ts_epoch DESC LIMIT ?', (limit,))
+        else:
+            c.execute(self._EVENT_COLUMNS + ' WHERE e.user_id = ? ORDER BY e.ts_epoch DESC LIMIT ?',
+                      (idagente, limit))
+        return c.fetchall()
+
+    def get_events_between(self, start_epoch, end_epoch, idagente=None):
+        """Eventos con start_epoch <= ts_epoch < end_epoch, en orden cronológico."""
+        c = self.reader.cursor()
+        if idagente is None:
+            c.execute(self._EVENT_COLUMNS + ' WHERE e.ts_epoch >= ? AND e.ts_epoch < ? ORDER BY e.ts_epoch',
+                      (start_epoch, end_epoch))
+        else:
+            c.execute(self._EVENT_COLUMNS +
+                      ' WHERE e.user_id = ? AND e.ts_epoch >= ? AND e.ts_epoch < ? ORDER BY e.ts_epoch',
+                      (idagente, start_epoch, end_epoch))
+        return c.fetchall()
+
+    def get_events_for_day(self, day, idagente=None):
+        """Eventos del día local `day` (date) según el offset de la terminal."""
+        midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        start_epoch = int(midnight.timestamp()) - self.utc_offset_minutes * 60
+        return self.get_events_between(start_epoch, start_epoch + 86400, idagente)
+
+    def get_events_for_agent(self, idagente, start_epoch=0, end_epoch=2 ** 62):
+        return self.get_events_between(start_epoch, end_epoch, idagente)
 
     def get_user(self, user_id):
-        c = self.conn.cursor()
+        c = self.reader.cursor()
         c.execute('SELECT * FROM users WHERE idagente = ?', (user_id,))
         return c.fetchone()
 
     def get_unsynced_events(self):
-        c = self.conn.cursor()
+        c = self.reader.cursor()
         c.execute('SELECT * FROM events WHERE synced = 0')
         return c.fetchall()
 
@@ -130,11 +671,418 @@ class LocalDB:
             c.execute('UPDATE events SET synced = 1 WHERE id = ?', (event_id,))
             self.conn.commit()
 
-    def get_unsynced_attlogs(self):
-        c = self.conn.cursor()
-        c.execute('''
+    def mark_events_synced(self, event_ids, high_water_mark=None):
+        """
+        Marca varios eventos como sincronizados en una sola transacción (un solo fsync).
+        Los tramos contiguos se actualizan con BETWEEN y los ids sueltos con IN (...).
+        Si se pasa high_water_mark se persiste en la misma transacción.
+        """
+        ids = sorted(set(event_ids))
+        if not ids and high_water_mark is None:
+            return 0
+
+        runs = _id_runs(ids)
+        singles = [lo for lo, hi in runs if lo == hi]
+        ranges = [(lo, hi) for lo, hi in runs if lo != hi]
+
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                for lo, hi in ranges:
+                    c.execute('UPDATE events SET synced = ? WHERE id BETWEEN ? AND ?', (EVENT_SYNCED, lo, hi))
+                for start in range(0, len(singles), MAX_SQL_VARIABLES):
+                    chunk = singles[start:start + MAX_SQL_VARIABLES]
+                    placeholders = ",".join("?" * len(chunk))
+                    c.execute(f'UPDATE events SET synced = ? WHERE id IN ({placeholders})', [EVENT_SYNCED] + chunk)
+                if high_water_mark is not None:
+                    self._set_state(c, ATTLOG_HWM_KEY, int(high_water_mark))
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+        return len(ids)
+
+    def get_unsynced_attlogs(self, limit=None, after_id=0):
+        c = self.reader.cursor()
+        query = '''
             SELECT events.id, user_id, timestamp
             FROM events
-            WHERE synced = 0
-        ''')
-        return c.fetchall()
\ No newline at end of file
+            WHERE synced = 0 AND id > ?
+            ORDER BY id
+        '''
+        params = [after_id]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        c.execute(query, params)
+        return c.fetchall()
+
+    def claim_unsynced_attlogs(self, limit, after_id=0):
+        """
+        Toma la siguiente página de eventos pendientes y la marca "en vuelo" en la
+        misma transacción, para que nadie más la pueda enviar en paralelo.
+        """
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                rows = c.execute('''
+                    SELECT events.id, user_id, timestamp
+                    FROM events
+                    WHERE synced = 0 AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (after_id, limit)).fetchall()
+                if rows:
+                    c.execute(
+                        'UPDATE events SET synced = ? WHERE synced = ? AND id BETWEEN ? AND ?',
+                        (EVENT_IN_FLIGHT, EVENT_PENDING, rows[0][0], rows[-1][0])
+                    )
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+        return rows
+
+    def release_events(self, event_ids):
+        """Devuelve eventos "en vuelo" a pendiente tras una subida fallida."""
+        ids = list(event_ids)
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                for start in range(0, len(ids), MAX_SQL_VARIABLES):
+                    chunk = ids[start:start + MAX_SQL_VARIABLES]
+                    placeholders = ",".join("?" * len(chunk))
+                    c.execute(
+                        f'UPDATE events SET synced = ? WHERE synced = ? AND id IN ({placeholders})',
+                        [EVENT_PENDING, EVENT_IN_FLIGHT] + chunk
+                    )
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+    def reset_in_flight_events(self):
+        """Al arrancar, lo que quedó "en vuelo" por un corte vuelve a pendiente."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('UPDATE events SET synced = ? WHERE synced = ?', (EVENT_PENDING, EVENT_IN_FLIGHT))
+            self.conn.commit()
+            return c.rowcount
+
+    # ---------------------------------------------------------------------
+    #  Archivo y compactación: los eventos sincronizados más viejos que la
+    #  retención se mueven a un SQLite por mes (archive/events-AAAA-MM.db).
+    # ---------------------------------------------------------------------
+    def archive_synced_events(self, before_epoch, archive_dir="archive", batch_rows=ARCHIVE_BATCH_ROWS):
+        """
+        Mueve los eventos sincronizados con ts_epoch < before_epoch a su archivo
+        mensual, en lotes de batch_rows por transacción: entre lote y lote se
+        suelta el candado, así el push de checadas (y el EventWriter de la UI)
+        no esperan detrás de un archivo de meses completos.
+        """
+        os.makedirs(archive_dir, exist_ok=True)
+        month_expr = "strftime('%Y-%m', ts_epoch + COALESCE(utc_offset, 0) * 60, 'unixepoch')"
+        moved = {}
+
+        # Rango de ids por mes, leído fuera del candado: cada lote queda acotado y
+        # el último de un mes no recorre el resto de la tabla buscando más filas
+        months = self.reader.execute(
+            f'''
+            SELECT {month_expr}, MIN(id), MAX(id) FROM events
+            WHERE synced = ? AND ts_epoch < ?
+            GROUP BY 1 ORDER BY 1
+            ''',
+            (EVENT_SYNCED, before_epoch)
+        ).fetchall()
+
+        for month, first_id, last_month_id in months:
+            path = os.path.join(archive_dir, f"{ARCHIVE_FILE_PREFIX}{month}.db")
+            where = f'synced = ? AND ts_epoch < ? AND {month_expr} = ?'
+            params = (EVENT_SYNCED, before_epoch, month)
+            with self.lock:
+                self.conn.execute("ATTACH DATABASE ? AS archive", (path,))
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS archive.events (
+                        id INTEGER PRIMARY KEY,
+                        user_id INTEGER,
+                        timestamp TEXT,
+                        ts_epoch INTEGER,
+                        utc_offset INTEGER,
+                        type TEXT
+                    )
+                ''')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_events_user_ts ON events (user_id, ts_epoch)')
+                self.conn.commit()
+
+            moved[month] = 0
+            last_id = first_id - 1
+            try:
+                while True:
+                    with self.lock:
+                        c = self.conn.cursor()
+                        try:
+                            # Con WAL el commit no es atómico entre bases adjuntas: INSERT OR IGNORE
+                            # hace que repetir un lote tras un corte sea inocuo.
+                            c.execute("BEGIN IMMEDIATE")
+                            ids = [row[0] for row in c.execute(
+                                f'SELECT id FROM main.events WHERE id > ? AND id <= ? AND {where} ORDER BY id LIMIT ?',
+                                (last_id, last_month_id) + params + (batch_rows,)
+                            )]
+                            if not ids:
+                                self.conn.commit()
+                                break
+                            batch = f'id BETWEEN ? AND ? AND {where}'
+                            batch_params = (ids[0], ids[-1]) + params
+                            c.execute(f'''
+                                INSERT OR IGNORE INTO archive.events (id, user_id, timestamp, ts_epoch, utc_offset, type)
+                                SELECT id, user_id, timestamp, ts_epoch, utc_offset, type FROM main.events WHERE {batch}
+                            ''', batch_params)
+                            c.execute(f'DELETE FROM main.events WHERE {batch}', batch_params)
+                            moved[month] += c.rowcount
+                            self.conn.commit()
+                            last_id = ids[-1]
+                        except sqlite3.Error:
+                            self.conn.rollback()
+                            raise
+                    self._checkpoint_between_batches()
+            finally:
+                with self.lock:
+                    self.conn.execute("DETACH DATABASE archive")
+
+        for month, count in moved.items():
+            logging.info(f"🗃️ Archived {count} events to {ARCHIVE_FILE_PREFIX}{month}.db")
+        return moved
+
+    def incremental_vacuum(self, batch_pages=VACUUM_BATCH_PAGES):
+        """
+        Devuelve al sistema las páginas libres si la base tiene
+        auto_vacuum=INCREMENTAL (las creadas desde que LocalDB lo fija), de
+        batch_pages en batch_pages para no retener el candado de escritura. Una
+        base más vieja no se convierte aquí: eso exige un VACUUM completo que
+        bloquea a la UI por más que su busy_timeout; sus páginas libres se
+        reutilizan para eventos nuevos y el archivo deja de crecer.
+        """
+        if self.reader.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logging.info("🧹 auto_vacuum is not INCREMENTAL on this database, skipping vacuum")
+            return
+        while True:
+            with self.lock:
+                if not self.conn.execute("PRAGMA freelist_count").fetchone()[0]:
+                    break
+                # executescript avanza el pragma hasta el final; execute() solo libera una página
+                self.conn.executescript(f"PRAGMA incremental_vacuum({int(batch_pages)});")
+            self._checkpoint_between_batches()
+
+    def _checkpoint_between_batches(self):
+        """
+        Checkpoint PASSIVE (no bloquea escritores ni lectores) y una pausa corta.
+        Sin el checkpoint el WAL crece y el autocheckpoint cae dentro del commit
+        de un lote, o peor, del siguiente commit del push; sin la pausa el lote
+        siguiente toma el candado antes de que el busy handler de otra conexión
+        (que reintenta con espera creciente) lo vea libre.
+        """
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        time.sleep(MAINTENANCE_BATCH_PAUSE)
+
+    def compact_events(self, retention_days, archive_dir="archive"):
+        before_epoch = int(time.time()) - int(retention_days) * 86400
+        moved = self.archive_synced_events(before_epoch, archive_dir)
+        self.incremental_vacuum()
+        return moved
+
+    @staticmethod
+    def list_archived_months(archive_dir="archive"):
+        if not os.path.isdir(archive_dir):
+            return []
+        return sorted(
+            name[len(ARCHIVE_FILE_PREFIX):-3]
+            for name in os.listdir(archive_dir)
+            if name.startswith(ARCHIVE_FILE_PREFIX) and name.endswith(".db")
+        )
+
+    @staticmethod
+    def query_archived_events(month, archive_dir="archive", idagente=None):
+        """
+        Lee bajo demanda un mes archivado ("AAAA-MM"), sin tocar la base activa.
+        Filas: (id, user_id, timestamp, ts_epoch, utc_offset, type).
+        """
+        path = os.path.join(archive_dir, f"{ARCHIVE_FILE_PREFIX}{month}.db")
+        if not os.path.exists(path):
+            return []
+        conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            query = 'SELECT id, user_id, timestamp, ts_epoch, utc_offset, type FROM events'
+            params = ()
+            if idagente is not None:
+                query += ' WHERE user_id = ?'
+                params = (idagente,)
+            return conn.execute(query + ' ORDER BY ts_epoch', params).fetchall()
+        finally:
+            conn.close()
+
+    def get_attlog_high_water_mark(self):
+        return int(self.get_state(ATTLOG_HWM_KEY, 0))
+
+    def set_adms_link(self, state, retry_at=0, failures=0):
+        """Estado del circuit breaker de ADMS: lo escribe sync_service, lo lee la UI."""
+        self.set_state(ADMS_LINK_KEY, f"{state} {int(retry_at)} {int(failures)}")
+
+    def get_adms_link(self):
+        """(estado, siguiente reintento en epoch, fallas seguidas); None si el sync nunca lo escribió."""
+        value = self.get_state(ADMS_LINK_KEY)
+        if not value:
+            return None
+        state, retry_at, failures = value.split()
+        return state, int(retry_at), int(failures)
+
+    @staticmethod
+    def _set_state(c, key, value):
+        c.execute(
+            'INSERT INTO device_state (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, str(value))
+        )
+
+    @staticmethod
+    def _bump_roster_version(c):
+        # Misma transacción que el cambio de usuarios/huellas: la UI recarga su caché al verlo
+        c.execute(
+            "INSERT INTO device_state (key, value) VALUES (?, '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            (ROSTER_VERSION_KEY,)
+        )
+
+    def set_state(self, key, value):
+        with self.lock:
+            self._set_state(self.conn.cursor(), key, value)
+            self.conn.commit()
+
+    def get_state(self, key, default=None):
+        c = self.reader.cursor()
+        row = c.execute('SELECT value FROM device_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+
+
+class EventWriter:
+    """
+    Hilo escritor de eventos con group commit: el listener solo encola y
+    regresa; los eventos se escriben en lote cada flush_interval_ms o cada
+    max_batch eventos, en una transacción (un fsync por lote).
+
+    durability → "idle": además se hace commit en cuanto la cola queda vacía
+                 (latencia mínima de persistencia, agrupa solo en ráfagas).
+                 "batch": se espera siempre al intervalo o al lote lleno.
+    on_flush   → callback(eventos) después de cada commit, desde el hilo
+                 escritor. No se llama después de stop(): quien detiene suele
+                 ser el hilo de Tk, bloqueado en join().
+    """
+
+    DURABILITY_POLICIES = ("idle", "batch")
+    _STOP = object()
+
+    def __init__(self, db, flush_interval_ms=200, max_batch=50, max_queue=1000,
+                 durability="idle", on_flush=None):
+        if durability not in self.DURABILITY_POLICIES:
+            raise ValueError(f"Invalid durability policy: {durability}")
+
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.durability = durability
+        self.on_flush = on_flush
+        self._stopping = False
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, user_id, type="checkin", ts_epoch=None, utc_offset=None):
+        if ts_epoch is None:
+            ts_epoch = int(time.time())
+        event = (user_id, type, ts_epoch, utc_offset)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # Nunca se descarta una checada: si la cola está llena se escribe en línea
+            logging.warning("⚠️ Event queue full, writing event synchronously")
+            self.db.add_event(user_id, type=type, ts_epoch=ts_epoch, utc_offset=utc_offset)
+
+    def flush(self, timeout=5):
+        """Bloquea hasta que todo lo encolado antes de la llamada está en disco; False si vence el timeout."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=5):
+        if self._thread.is_alive():
+            self._stopping = True
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _write(self, batch):
+        try:
+            with METRICS.timer("db.event_commit"):
+                self.db.add_events(batch)
+        except Exception:
+            logging.exception(f"💥 Failed to write {len(batch)} events, will retry")
+            time.sleep(0.5)
+            return False
+
+        logging.debug(f"💾 Group commit: {len(batch)} events")
+        if self.on_flush and not self._stopping:
+            try:
+                self.on_flush(batch)
+            except Exception:
+                logging.exception("💥 Event flush callback failed")
+        return True
+
+    def _run(self):
+        batch = []
+        waiters = []  # flush() pendientes: se liberan solo cuando el lote quedó en disco
+        deadline = None
+
+        while True:
+            timeout = None if not batch else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                while batch and not self._write(batch):
+                    pass
+                for waiter in waiters:
+                    waiter.set()
+                return
+
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+                if batch and not self._write(batch):
+                    deadline = time.monotonic() + self.flush_interval
+                    continue
+                batch = []
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
+                continue
+
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            due = (
+                item is None
+                or len(batch) >= self.max_batch
+                or (self.durability == "idle" and self._queue.empty())
+            )
+            if batch and due:
+                if self._write(batch):
+                    batch = []
+                    for waiter in waiters:
+                        waiter.set()
+                    waiters = []
+                else:
+                    deadline = time.monotonic() + self.flush_interval
@@ -1,41 +1,56 @@
 # fingerprint_manager.py (patched version)
 import time
 import threading
-import requests
-import re
-import socket
-import os
-import subprocess
-import shutil
-import psutil
-import uuid
 import pygame
-from datetime import datetime, timedelta
-import json
 import glob
-from db import LocalDB
+import struct
+from collections import OrderedDict
+from config import CONFIG
+from db import LocalDB, EventWriter, local_datetime
+from touch_detector import create_touch_detector, RetouchWatch
+from template_store import HostTemplateIndex
+from metrics import METRICS
+from sync_notify import SyncNotifier
 import adafruit_fingerprint as af
 import logging
 import serial
 
 
-with open(os.path.join(os.path.dirname(__file__), "config.json")) as f:
-    CONFIG = json.load(f)
-
-def get_device_sn(prefix="WBIO"):
-    try:
-        with open('/proc/cpuinfo', 'r') as f:
-            for line in f:
-                if line.startswith('Serial'):
-                    serial = line.strip().split(":")[1].strip()
-                    return f"{prefix}{serial[-6:].upper()}"
-    except Exception as e:
-        return f"{prefix}000000"    
-
 MAX_FINGERPRINTS_PER_USER = CONFIG.get("MAX_FINGERPRINTS_PER_USER", 1)
-SN = get_device_sn(CONFIG.get("SN_PREFIX", "WBIO"))
-ADMS_URL = CONFIG["ADMS_URL"]
 TIMEZONE_OFFSET = CONFIG.get("TIMEZONE_OFFSET", -6)
+IDENTITY_REFRESH_SECONDS = CONFIG.get("IDENTITY_REFRESH_SECONDS", 5)
+EVENT_FLUSH_INTERVAL_MS = CONFIG.get("EVENT_FLUSH_INTERVAL_MS", 200)
+EVENT_FLUSH_MAX_BATCH = CONFIG.get("EVENT_FLUSH_MAX_BATCH", 50)
+EVENT_QUEUE_SIZE = CONFIG.get("EVENT_QUEUE_SIZE", 1000)
+EVENT_DURABILITY = CONFIG.get("EVENT_DURABILITY", "idle")
+DUPLICATE_SCAN_WINDOW_SECONDS = CONFIG.get("DUPLICATE_SCAN_WINDOW_SECONDS", 60)
+FINGER_DETECT_MODE = CONFIG.get("FINGER_DETECT_MODE", "auto")
+FINGER_TOUCH_GPIO = CONFIG.get("FINGER_TOUCH_GPIO")
+FINGER_TOUCH_SERIAL_LINE = CONFIG.get("FINGER_TOUCH_SERIAL_LINE", "cts")
+FINGER_TOUCH_ACTIVE_LOW = CONFIG.get("FINGER_TOUCH_ACTIVE_LOW", False)
+POLL_MIN_INTERVAL = CONFIG.get("POLL_MIN_INTERVAL", 0.05)
+POLL_MAX_INTERVAL = CONFIG.get("POLL_MAX_INTERVAL", 0.4)
+SENSOR_PORT = CONFIG.get("SENSOR_PORT")
+SENSOR_BAUDRATE = CONFIG.get("SENSOR_BAUDRATE", 115200)
+SENSOR_AUTO_BAUD = CONFIG.get("SENSOR_AUTO_BAUD", True)
+SENSOR_SEARCH_MODE = CONFIG.get("SENSOR_SEARCH_MODE", "range")
+SLOT_COMPACT_MIN_GAP = CONFIG.get("SLOT_COMPACT_MIN_GAP", 8)
+HOST_TEMPLATE_STORE = CONFIG.get("HOST_TEMPLATE_STORE", True)
+HOST_MATCH_MAX_CANDIDATES = CONFIG.get("HOST_MATCH_MAX_CANDIDATES", 0)  # 0 = sin tope, solo el tiempo
+HOST_MATCH_TIMEOUT_SECONDS = CONFIG.get("HOST_MATCH_TIMEOUT_SECONDS", 1.5)
+HOST_MATCH_RETOUCH_PROBE = CONFIG.get("HOST_MATCH_RETOUCH_PROBE", 0.3)
+SQLITE_SYNCHRONOUS = CONFIG.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = CONFIG.get("SQLITE_BUSY_TIMEOUT_MS", 5000)
+
+# Velocidades R30x/AS608: 9600 × N con N = 1..12 (parámetro de sistema 4)
+SENSOR_BAUD_RATES = [9600 * n for n in range(1, 13)]
+SENSOR_BAUDRATE_KEY = "sensor_baudrate"
+BAUD_PARAM = 4
+# VfyPwd con contraseña 0 a la dirección por defecto; sirve para sondear la velocidad
+_VERIFY_PASSWORD_PACKET = bytes.fromhex("EF01FFFFFFFF01000713" "00000000" "001B")
+
+# Lo devuelve _match_host_templates si otro dedo llegó a media verificación
+RETOUCHED = object()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -46,6 +61,51 @@ logging.basicConfig(
     ]
 )
 
+def search_slot_range(finger, start, count, fast=False):
+    """
+    Search/HighSpeedSearch del char buffer 1 sobre los slots [start, start + count)
+    sin el read_sysparam que finger_search() manda antes de cada búsqueda.
+    Deja finger_id y confidence en el objeto igual que la librería.
+    """
+    command = af._HISPEEDSEARCH if fast else af._FINGERPRINTSEARCH
+    finger._send_packet([command, 0x01, start >> 8, start & 0xFF, count >> 8, count & 0xFF])
+    r = finger._get_packet(16)
+    finger.finger_id, finger.confidence = struct.unpack(">HH", bytes(r[1:5]))
+    return r[0]
+
+
+class DuplicateScanFilter:
+    """
+    Ventana de supresión de checadas repetidas por agente.
+    OrderedDict idagente → instante (monotonic) de la última checada registrada,
+    en orden de tiempo: las entradas vencidas se sacan por el frente, así el
+    tamaño queda acotado por la gente que checó dentro de la ventana.
+    """
+
+    def __init__(self, window_seconds=60):
+        self.window = window_seconds
+        self._recent = OrderedDict()
+
+    def is_duplicate(self, idagente, now=None):
+        """True si idagente ya checó dentro de la ventana; si no, registra esta checada."""
+        if self.window <= 0:
+            return False
+        if now is None:
+            now = time.monotonic()
+
+        while self._recent:
+            oldest_at = next(iter(self._recent.values()))
+            if now - oldest_at < self.window:
+                break
+            self._recent.popitem(last=False)
+
+        if idagente in self._recent:
+            return True
+
+        self._recent[idagente] = now
+        return False
+
+
 class FingerprintManager:
     def __init__(self, port: str | None = None,
              baudrate: int = 57600,
@@ -53,7 +113,8 @@ class FingerprintManager:
         """
         port       →  Si se pasa, se usa tal cual.  
                     Si es None, se intentan automáticamente /dev/ttyACM* y /dev/ttyUSB*.
-        baudrate   →  Conserva 57600 por defecto (cambia si lo necesitas).
+        baudrate   →  Velocidad inicial a probar (57600 de fábrica). Si SENSOR_AUTO_BAUD
+                    está activo se negocia SENSOR_BAUDRATE y se recuerda en la base.
         """
 
         print("🔄 Initializing FingerprintManager…")
@@ -61,9 +122,14 @@ class FingerprintManager:
         # Default to None to avoid AttributeError later
         self.finger = None
 
-        # 1️⃣ Auto-detect port if needed
+        # La base se abre primero: guarda la velocidad negociada con el sensor
+        self.db = LocalDB(synchronous=SQLITE_SYNCHRONOUS,
+                          busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                          utc_offset_hours=TIMEZONE_OFFSET)
+
+        # 1️⃣ Auto-detect port if needed (SENSOR_PORT fija uno, p. ej. el pty de sensor_emulator)
         if port is None:
-            port = self._auto_detect_port(baudrate)
+            port = SENSOR_PORT or self._auto_detect_port(baudrate)
 
         # 2️⃣ Try to open serial port
         try:
@@ -72,7 +138,14 @@ class FingerprintManager:
         except serial.SerialException as exc:
             raise RuntimeError(f"❌  No se pudo abrir {port}: {exc}") from exc
 
-        # 3️⃣ Try to init the fingerprint sensor
+        # 3️⃣ Find the rate the sensor is answering at (last negotiated one first)
+        stored_baud = self.db.get_state(SENSOR_BAUDRATE_KEY)
+        preferred = [int(stored_baud)] if stored_baud else []
+        detected = self._probe_baudrate(preferred + [baudrate])
+        if detected:
+            logging.info(f"📶 Sensor responde a {detected} baud")
+
+        # 4️⃣ Try to init the fingerprint sensor
         try:
             self.finger = af.Adafruit_Fingerprint(self.uart)
 
@@ -82,14 +155,65 @@ class FingerprintManager:
             logging.exception("❌  Error inicializando el sensor")
             self.finger = None  # ensure attribute always exists
 
+        if self.finger and SENSOR_AUTO_BAUD:
+            self._negotiate_baudrate(SENSOR_BAUDRATE)
+
+        self.touch_detector = create_touch_detector(
+            FINGER_DETECT_MODE,
+            uart=self.uart,
+            gpio_pin=FINGER_TOUCH_GPIO,
+            serial_line=FINGER_TOUCH_SERIAL_LINE,
+            active_low=FINGER_TOUCH_ACTIVE_LOW,
+            poll_min_interval=POLL_MIN_INTERVAL,
+            poll_max_interval=POLL_MAX_INTERVAL,
+        )
+
         self.play_sound("audios/system_ready.wav")
-        # 4️⃣ Other instance attributes
+        # 5️⃣ Other instance attributes
         self.update_callback = update_callback
         self.pause_listener = False
         self.allow_listener = True
         self._listener_running = False
         self._listener_thread = None
-        self.db = LocalDB()
+        self._compaction_pending = False
+        self._compaction_moves = 0
+
+        # Escritura diferida de checadas: el listener solo encola
+        self.sync_notifier = SyncNotifier()
+        self.event_writer = EventWriter(
+            self.db,
+            flush_interval_ms=EVENT_FLUSH_INTERVAL_MS,
+            max_batch=EVENT_FLUSH_MAX_BATCH,
+            max_queue=EVENT_QUEUE_SIZE,
+            durability=EVENT_DURABILITY,
+            on_flush=self._on_events_flushed,
+        )
+
+        self.scan_filter = DuplicateScanFilter(DUPLICATE_SCAN_WINDOW_SECONDS)
+
+        # 6️⃣ Capacidad real de la librería (read_sysparam ya corrió al crear el sensor)
+        if self.finger and self.finger.library_size:
+            self.db.set_slot_capacity(self.finger.library_size)
+        self.capacity = self.db.slot_capacity
+        logging.info(f"📚 Sensor library capacity: {self.capacity} slots")
+
+        # 7️⃣ Caché finger_id → (idagente, nombre) para que un match no toque disco
+        self._identity_cache = {}
+        self._identity_lock = threading.Lock()
+        self._identity_version = None
+        self._identity_checked_at = 0
+        self.reload_identity_cache()
+
+        # 8️⃣ Librería fragmentada (p. ej. tras borrados en otra versión): se compacta antes del listener
+        try:
+            self.compact_sensor_slots_if_fragmented()
+        except Exception:
+            logging.exception("⚠️ Sensor library compaction failed")
+
+        # 9️⃣ Store de templates en el host: huellas previas se descargan una sola vez
+        self._host_index = None
+        if HOST_TEMPLATE_STORE:
+            self._backfill_host_templates()
 
 
     # ---------------------------------------------------------------------
@@ -121,10 +245,314 @@ class FingerprintManager:
             f"❌  Ninguno de los puertos {', '.join(candidates)} está disponible"
         )
 
+    # ---------------------------------------------------------------------
+    #  Caché de identidades (slot del sensor → agente)
+    # ---------------------------------------------------------------------
+    def reload_identity_cache(self):
+        identities = {
+            fid: (idagente, name or f"User {idagente}")
+            for fid, (idagente, name) in self.db.get_identity_map().items()
+        }
+        with self._identity_lock:
+            self._identity_cache = identities
+        logging.info(f"🪪 Identity cache loaded: {len(identities)} fingerprints")
+
+    def _refresh_identity_cache_if_stale(self):
+        """
+        Se llama desde el hilo del listener mientras está ocioso. Recarga la caché
+        si cambió roster_version en device_state (p. ej. el proceso de sync
+        aplicó USERINFO); las checadas y los acks de ATTLOG no la mueven.
+        """
+        now = time.monotonic()
+        if now - self._identity_checked_at < IDENTITY_REFRESH_SECONDS:
+            return
+        self._identity_checked_at = now
+
+        version = self.db.roster_version()
+        if self._identity_version is not None and version != self._identity_version:
+            self.reload_identity_cache()
+        self._identity_version = version
+
+    def _lookup_identity(self, finger_id):
+        with self._identity_lock:
+            identity = self._identity_cache.get(finger_id)
+        if identity:
+            return identity
+
+        # Fallo de caché: se consulta la base una vez y se guarda el resultado
+        agent_id = self.db.get_agent_by_finger_id(finger_id)
+        if not agent_id:
+            return None
+        user = self.db.get_user(agent_id)
+        identity = (agent_id, user[3] if user and user[3] else f"User {agent_id}")
+        with self._identity_lock:
+            self._identity_cache[finger_id] = identity
+        return identity
+
+    def _cache_fingerprint(self, finger_id, idagente):
+        user = self.db.get_user(idagente)
+        name = user[3] if user and user[3] else f"User {idagente}"
+        with self._identity_lock:
+            self._identity_cache[finger_id] = (idagente, name)
+
+    def _uncache_agent(self, idagente):
+        with self._identity_lock:
+            for fid in [fid for fid, (aid, _) in self._identity_cache.items() if aid == idagente]:
+                del self._identity_cache[fid]
+
+    def _move_cached_fingerprint(self, old_finger_id, new_finger_id):
+        with self._identity_lock:
+            identity = self._identity_cache.pop(old_finger_id, None)
+            if identity:
+                self._identity_cache[new_finger_id] = identity
+
+    # ---------------------------------------------------------------------
+    #  Búsqueda en la librería del sensor
+    # ---------------------------------------------------------------------
+    def _search_library(self):
+        """
+        finger_search() de la librería manda read_sysparam en cada llamada y
+        recorre toda la capacidad. Aquí se busca solo en el tramo ocupado según
+        el bitmap de slots, con Search (0x04) o HighSpeedSearch (0x1B).
+        SENSOR_SEARCH_MODE → "range" | "fast" | "full" (comportamiento original).
+        """
+        f = self.finger
+        if SENSOR_SEARCH_MODE == "full":
+            return f.finger_search()
+
+        span = self.db.get_occupied_span()
+        if span is None:
+            return af.NOTFOUND
+
+        start, end = span
+        return search_slot_range(f, start, end - start + 1, fast=SENSOR_SEARCH_MODE == "fast")
+
+    def _move_top_template(self):
+        """
+        Mueve el template del slot más alto al hueco más bajo. Orden seguro ante
+        un corte: se guarda en el slot nuevo, se actualiza la base y al final se
+        borra el viejo. None si el tramo ya es contiguo, False si el sensor falló.
+        """
+        span = self.db.get_occupied_span()
+        if span is None or span[1] + 1 == self.db.count_used_slots():
+            return None
+
+        f = self.finger
+        old_fid = span[1]
+        new_fid = self.db.get_next_available_finger_id()
+        if f.load_model(old_fid, 1) != af.OK or f.store_model(new_fid, 1) != af.OK:
+            logging.error(f"❌ Could not move template {old_fid} → {new_fid}, compaction stopped")
+            return False
+
+        self.db.move_fingerprint(old_fid, new_fid)
+        self._move_cached_fingerprint(old_fid, new_fid)
+        if f.delete_model(old_fid) != af.OK:
+            logging.warning(f"⚠️ Template {old_fid} copied to {new_fid} but not deleted from sensor")
+        return True
+
+    def compact_sensor_slots(self):
+        """
+        Mueve templates hasta que el tramo ocupado quede contiguo desde 0. Solo
+        para el arranque, antes del listener; con el listener vivo se usa
+        _compact_step_if_pending, que corre en su propio hilo.
+        """
+        if not self.finger:
+            return 0
+
+        moved = 0
+        while self._move_top_template():
+            moved += 1
+
+        if moved:
+            logging.info(f"🧹 Sensor library compacted: {moved} template(s) moved, span now {self.db.get_occupied_span()}")
+        return moved
+
+    def _compact_step_if_pending(self):
+        """
+        Un movimiento de compactación por vuelta ociosa del listener: el UART
+        sigue siendo solo suyo y un dedo espera como mucho un load/store/delete.
+        """
+        if not self._compaction_pending or not self.finger:
+            return
+        if self._move_top_template():
+            self._compaction_moves += 1
+            return
+
+        self._compaction_pending = False
+        if self._compaction_moves:
+            logging.info(f"🧹 Sensor library compacted: {self._compaction_moves} template(s) moved, "
+                         f"span now {self.db.get_occupied_span()}")
+        self._compaction_moves = 0
+
+    # ---------------------------------------------------------------------
+    #  Store de templates en el host: el sensor funciona como caché LRU
+    # ---------------------------------------------------------------------
+    def _backfill_host_templates(self):
+        """Descarga del sensor los templates que aún no están en la base."""
+        f = self.finger
+        missing = self.db.get_slots_missing_template()
+        if not f or not missing:
+            return
+
+        logging.info(f"⬇️ Downloading {len(missing)} template(s) from the sensor to the host store")
+        for fid in missing:
+            try:
+                if f.load_model(fid, 1) == af.OK:
+                    self.db.save_template(fid, bytes(f.get_fpdata("char", 1)))
+                else:
+                    logging.warning(f"⚠️ Could not load template {fid} from sensor")
+            except Exception:
+                logging.exception(f"⚠️ Error downloading template {fid}")
+
+    def _host_templates(self):
+        if self._host_index is None:
+            self._host_index = HostTemplateIndex(self.db.get_host_only_templates())
+        return self._host_index
+
+    def _allocate_sensor_slot(self):
+        """Slot libre; con la librería llena se saca del sensor la huella usada hace más tiempo."""
+        try:
+            return self.db.get_next_available_finger_id()
+        except Exception:
+            victim = self.db.get_least_recent_slot() if HOST_TEMPLATE_STORE else None
+            if victim is None:
+                raise
+
+        result = self.finger.delete_model(victim)
+        if result != af.OK:
+            raise RuntimeError(f"Could not evict template {victim} from sensor (result={result})")
+        self.db.evict_fingerprint(victim)
+        with self._identity_lock:
+            self._identity_cache.pop(victim, None)
+        self._host_index = None
+        logging.info(f"📤 Template {victim} evicted from the sensor (kept on host)")
+        return victim
+
+    def _match_host_templates(self):
+        """
+        Segundo nivel cuando la búsqueda en el sensor falla: la huella capturada
+        sigue en el char buffer 1 y se compara contra cada template del host
+        (subido al char buffer 2), del agente que checó más recientemente hacia
+        atrás. Cada candidato cuesta ~64 ms a 115200 baud (ver
+        benchmarks/bench_host_match.py), así que la vuelta se corta a los
+        HOST_MATCH_TIMEOUT_SECONDS o si el dedo se levanta y vuelve a ponerse.
+        Un match se sube al sensor para que la siguiente checada se resuelva ahí.
+        Devuelve (idagente, nombre), None o RETOUCHED.
+        """
+        index = self._host_templates()
+        f = self.finger
+        started = time.monotonic()
+        deadline = started + HOST_MATCH_TIMEOUT_SECONDS if HOST_MATCH_TIMEOUT_SECONDS else None
+        watch = RetouchWatch(self.touch_detector,
+                             capture=lambda: f.get_image() != af.NOFINGER,
+                             probe_interval=HOST_MATCH_RETOUCH_PROBE)
+
+        checked = 0
+        for i in index.candidates(HOST_MATCH_MAX_CANDIDATES):
+            if deadline is not None and time.monotonic() >= deadline:
+                METRICS.record("scan.host_match.timeout", time.monotonic() - started)
+                logging.info(f"⏱️ Host match stopped after {checked} of {len(index)} candidates")
+                return None
+            if watch.retouched():
+                METRICS.record("scan.host_match.retouched", time.monotonic() - started)
+                logging.info(f"👆 New touch after {checked} of {len(index)} host candidates")
+                return RETOUCHED
+
+            f.send_fpdata(list(index.templates[i]), "char", 2)
+            if f.compare_templates() == af.OK:
+                return self._promote_host_template(index.ids[i], index.agents[i])
+            checked += 1
+        return None
+
+    def _promote_host_template(self, fingerprint_id, idagente):
+        """Guarda en el sensor el template verificado (char buffer 2); si falla, el match sigue valiendo."""
+        try:
+            slot = self._allocate_sensor_slot()
+            if self.finger.store_model(slot, 2) == af.OK:
+                self.db.promote_fingerprint(fingerprint_id, slot)
+                self._host_index = None
+                self._cache_fingerprint(slot, idagente)
+                logging.info(f"📥 Template of agent {idagente} promoted to sensor slot {slot}")
+                return self._lookup_identity(slot)
+            logging.warning(f"⚠️ Could not store template of agent {idagente} in slot {slot}")
+        except Exception:
+            logging.exception(f"⚠️ Error promoting template of agent {idagente}")
+
+        user = self.db.get_user(idagente)
+        return (idagente, user[3] if user and user[3] else f"User {idagente}")
+
+    def _library_fragmented(self):
+        """True si los huecos dentro del tramo ocupado llegan a SLOT_COMPACT_MIN_GAP."""
+        span = self.db.get_occupied_span()
+        if span is None:
+            return False
+        return span[1] + 1 - self.db.count_used_slots() >= SLOT_COMPACT_MIN_GAP
+
+    def compact_sensor_slots_if_fragmented(self):
+        if not self._library_fragmented():
+            return 0
+        return self.compact_sensor_slots()
+
+    # ---------------------------------------------------------------------
+    #  Velocidad del UART
+    # ---------------------------------------------------------------------
+    def _sensor_responds(self, timeout=0.3):
+        """Manda VfyPwd a la velocidad actual del puerto y revisa el ACK crudo."""
+        previous_timeout = self.uart.timeout
+        try:
+            self.uart.timeout = timeout
+            self.uart.reset_input_buffer()
+            self.uart.write(_VERIFY_PASSWORD_PACKET)
+            ack = self.uart.read(12)
+        except serial.SerialException:
+            return False
+        finally:
+            self.uart.timeout = previous_timeout
+        return len(ack) == 12 and ack[:2] == b"\xef\x01" and ack[6] == 0x07 and ack[9] == af.OK
+
+    def _probe_baudrate(self, preferred=()):
+        """Prueba primero las velocidades preferidas y luego el resto; deja el puerto en la que responde."""
+        candidates = list(dict.fromkeys(
+            list(preferred) + sorted(SENSOR_BAUD_RATES, key=lambda b: (b != 57600, -b))
+        ))
+        for baud in candidates:
+            self.uart.baudrate = baud
+            if self._sensor_responds():
+                return baud
+        self.uart.baudrate = candidates[0]
+        return None
+
+    def _negotiate_baudrate(self, target):
+        """
+        Sube el módulo a `target` con SetSysPara(4, N) y verifica que siga
+        respondiendo; si no, vuelve a sondear. La velocidad que quede se persiste.
+        """
+        current = self.uart.baudrate
+        if target not in SENSOR_BAUD_RATES:
+            logging.warning(f"⚠️ SENSOR_BAUDRATE {target} no soportado; se queda en {current}")
+            target = current
+
+        if target != current:
+            try:
+                self.finger.set_sysparam(BAUD_PARAM, target // 9600)
+                self.uart.baudrate = target
+                if not self._sensor_responds(timeout=1):
+                    raise RuntimeError("no response after switching")
+                logging.info(f"⚡ Sensor UART negotiated: {current} → {target} baud")
+            except Exception as exc:
+                logging.warning(f"⚠️ Baud switch to {target} failed ({exc}); probing")
+                if not self._probe_baudrate([current, target]):
+                    logging.error("❌ Sensor stopped responding at every baud rate")
+                    return
+
+        self.finger.read_sysparam()
+        self.db.set_state(SENSOR_BAUDRATE_KEY, self.uart.baudrate)
+
     def play_sound(self, filename):
-        try:            
-            pygame.mixer.music.load(filename)
-            pygame.mixer.music.play()
+        try:
+            with METRICS.timer("ui.sound"):
+                pygame.mixer.music.load(filename)
+                pygame.mixer.music.play()
             print(f"🔊 Playing sound: {filename}")
         except Exception as e:
             print(f"⚠️ Failed to play sound {filename}: {e}")
@@ -145,37 +573,68 @@ class FingerprintManager:
                 return
 
             self.update_status("Listo para escanear huellas...")
+            self.reload_identity_cache()
+            self._identity_version = self.db.roster_version()
+            self._identity_checked_at = time.monotonic()
 
             while self._listener_running:
                 if self.pause_listener or not self.allow_listener:
                     time.sleep(0.5)
                     continue
 
+                self._refresh_identity_cache_if_stale()
+                self._compact_step_if_pending()
+
                 logging.debug("Esperando huella en pantalla principal...")
 
+                # Duerme hasta el flanco de touch (o el siguiente sondeo); el timeout
+                # permite revisar pausa/parada y la caché de identidades.
+                if not self.touch_detector.wait_for_touch(timeout=0.5):
+                    continue
+
+                scan_started = time.monotonic()
                 if f.get_image() == af.OK:
-                    if f.image_2_tz(1) != f.OK:
+                    # Solo se miden las capturas con dedo; los sondeos vacíos no cuentan
+                    METRICS.record("scan.get_image", time.monotonic() - scan_started)
+                    self.touch_detector.notify_activity()
+                    with METRICS.timer("scan.image_2_tz"):
+                        converted = f.image_2_tz(1)
+                    if converted != af.OK:
                         self.play_sound("audios/error_checada.wav")
                         self.update_status("❌ Huella no clara. Intente de nuevo")
                         continue
 
-                    if f.finger_search() != f.OK:
-                        self.play_sound("audios/no_match.wav")  # ← New sound, softer tone
-                        self.update_status("⚠️ Huella no reconocida")
-                        time.sleep(2)
-                        continue
-                    matched_fid = f.finger_id
-                    agent_id = self.db.get_agent_by_finger_id(matched_fid)
-
-                    if agent_id:
-                        user = self.db.conn.execute(
-                            "SELECT name FROM users WHERE idagente = ?", (agent_id,)
-                        ).fetchone()
-                        name = user[0] if user else f"User {agent_id}"
-
-                        now = datetime.utcnow() + timedelta(hours=TIMEZONE_OFFSET)
-                        timestamp = now.isoformat()
-                        self.db.add_event(agent_id, type="checkin", timestamp=timestamp)
+                    with METRICS.timer("scan.sensor_search"):
+                        found = self._search_library()
+                    if found == af.OK:
+                        with METRICS.timer("scan.identity_lookup"):
+                            identity = self._lookup_identity(f.finger_id)
+                    else:
+                        identity = None
+                        if HOST_TEMPLATE_STORE:
+                            with METRICS.timer("scan.host_match"):
+                                identity = self._match_host_templates()
+                            if identity is RETOUCHED:
+                                continue  # el dedo nuevo se procesa en la siguiente vuelta
+                        if identity is None:
+                            self.play_sound("audios/no_match.wav")  # ← New sound, softer tone
+                            self.update_status("⚠️ Huella no reconocida")
+                            METRICS.record("scan.total", time.monotonic() - scan_started)
+                            time.sleep(2)
+                            continue
+
+                    if identity and self.scan_filter.is_duplicate(identity[0]):
+                        # Repetición dentro de la ventana: aviso inmediato, sin escribir nada
+                        self.update_status(f"☑️ {identity[1]}, tu checada ya estaba registrada")
+                        if self.update_callback:
+                            self.play_sound("audios/checada_correcta.wav")
+                    elif identity:
+                        agent_id, name = identity
+
+                        ts_epoch = int(time.time())
+                        with METRICS.timer("scan.enqueue"):
+                            self.event_writer.enqueue(agent_id, type="checkin", ts_epoch=ts_epoch)
+                        now = local_datetime(ts_epoch, self.db.utc_offset_minutes)
                         now_display = now.strftime("%d/%m/%Y %H:%M")
 
                         self.update_status(f"✅ Checada registrada, {name}!\n⏰ {now_display}")
@@ -183,16 +642,14 @@ class FingerprintManager:
                         if self.update_callback:
                             self.play_sound("audios/checada_correcta.wav")
                             self.update_callback(f"Bienvenido {name}!\n⏰ {now_display}")
-
-                        if hasattr(self, "refresh_history"):
-                            self.refresh_history()
                     else:
                         self.play_sound("audios/no_match.wav")  # ← New sound, softer tone
                         self.update_status("⚠️ La huella no corresponde a un empleado")
 
+                    METRICS.record("scan.total", time.monotonic() - scan_started)
                     time.sleep(3)
-
-                time.sleep(0.2)
+                else:
+                    self.touch_detector.notify_idle()
 
         self._listener_thread = threading.Thread(target=listen, daemon=True)
         self._listener_thread.start()
@@ -201,30 +658,51 @@ class FingerprintManager:
 
     def stop_fingerprint_listener(self):
         self._listener_running = False
-        if hasattr(self, "_listener_thread") and self._listener_thread.is_alive():
+        if self._listener_thread and self._listener_thread.is_alive():
             self._listener_thread.join(timeout=2)
             logging.info("🛑 Fingerprint listener thread fully joined.")
         else:
             logging.info("🛑 Fingerprint listener was not active.")
 
+    def _on_events_flushed(self, events):
+        # Ya están en disco: sync_service puede subirlas sin esperar su intervalo
+        self.sync_notifier.notify()
+        if hasattr(self, "refresh_history"):
+            with METRICS.timer("ui.history_refresh"):
+                self.refresh_history()
+
+    def shutdown(self):
+        """Detiene el listener y vacía a disco las checadas pendientes (SIGTERM/SIGINT)."""
+        self.stop_fingerprint_listener()
+        self.touch_detector.close()
+        self.event_writer.stop()
+        self.sync_notifier.close()
+        logging.info("💾 Pending events flushed.")
+
     def update_status(self, message):
         if self.update_callback:
-            self.update_callback(message)
+            with METRICS.timer("ui.status"):
+                self.update_callback(message)
 
     def delete_fingerprints_for_user(self, idagente):
         try:
             finger_ids = self.db.get_finger_ids_by_user(idagente)
             for fid in finger_ids:
                 result = self.finger.delete_model(fid)
-                if result == self.finger.OK:
+                if result == af.OK:
                     logging.info(f"🗑️ Deleted fingerprint ID {fid} from sensor for user {idagente}")
-                elif result == self.finger.NOTFOUND:
+                elif result == af.NOTFOUND:
                     logging.warning(f"⚠️ Fingerprint ID {fid} not found on sensor")
                 else:
                     logging.error(f"❌ Failed to delete fingerprint ID {fid} from sensor, result: {result}")
 
             self.db.remove_fingerprints_by_user(idagente)
+            self._uncache_agent(idagente)
+            self._host_index = None
             logging.info(f"🗂️ Deleted fingerprint DB records for user {idagente}")
+            # La compactación la hace el listener en sus vueltas ociosas, no el botón de Tk
+            if self._library_fragmented():
+                self._compaction_pending = True
         except Exception as e:
             logging.exception(f"💥 Error deleting fingerprints for user {idagente}")
     
@@ -240,7 +718,8 @@ class FingerprintManager:
                         on_update("⚠️ El usuario ya tiene el máximo de huellas capturadas.")
                     return
 
-                finger_id = self.db.get_next_available_finger_id()
+                with METRICS.timer("enroll.allocate_slot"):
+                    finger_id = self._allocate_sensor_slot()
                 if on_update:
                     self.play_sound("audios/user_fingerprint_enroll.wav")
                     on_update(f"Capturando huella para usuario...")
@@ -250,7 +729,9 @@ class FingerprintManager:
                 # First scan
                 while f.get_image() != af.OK:
                     time.sleep(0.1)
-                if f.image_2_tz(1) != af.OK:
+                with METRICS.timer("enroll.image_2_tz"):
+                    converted = f.image_2_tz(1)
+                if converted != af.OK:
                     if on_update:
                         on_update("No se pudo leer la huella, reintente")
                     return
@@ -264,18 +745,36 @@ class FingerprintManager:
                     on_update("Coloque el dedo nuevamente...")
                 while f.get_image() != af.OK:
                     time.sleep(0.1)
-                if f.image_2_tz(2) != af.OK:
+                with METRICS.timer("enroll.image_2_tz"):
+                    converted = f.image_2_tz(2)
+                if converted != af.OK:
                     if on_update:
                         on_update("No se pudo leer la huella, reintente")
                     return
 
-                if f.create_model() != af.OK:
+                with METRICS.timer("enroll.create_model"):
+                    created = f.create_model()
+                if created != af.OK:
                     if on_update:
                         on_update("No se pudo crear la huella, reintente")
                     return
 
-                if f.store_model(finger_id) == af.OK:
-                    self.db.add_fingerprint(idagente, finger_id)
+                with METRICS.timer("enroll.store_model"):
+                    stored = f.store_model(finger_id)
+                if stored == af.OK:
+                    template = None
+                    if HOST_TEMPLATE_STORE:
+                        # El slot ya está escrito: un fallo aquí no debe dejarlo huérfano;
+                        # _backfill_host_templates lo descarga en el siguiente arranque
+                        try:
+                            with METRICS.timer("enroll.template_upload"):
+                                template = bytes(f.get_fpdata("char", 1))
+                        except Exception:
+                            logging.exception(f"⚠️ Could not download template {finger_id}; will retry at startup")
+                            template = None
+                    with METRICS.timer("enroll.db_insert"):
+                        self.db.add_fingerprint(idagente, finger_id, template)
+                    self._cache_fingerprint(finger_id, idagente)
                     if on_update:
                         on_update(f"✅ Se registró la huella para el usuario")
                 else:
@@ -290,226 +789,3 @@ class FingerprintManager:
                 logging.info("✅ Enrollment flow complete.")
 
         threading.Thread(target=enroll, daemon=True).start()
-
-    def send_handshake(self):
-        adms_url = f"{ADMS_URL}/iclock/cdata"
-        try:
-            ip = socket.gethostbyname(socket.gethostname())
-            params = {
-                "SN": SN,
-                "options": "all",
-                "language": "101",
-                "pushver": "3.0.0",
-                "PushOptionsFlag": "1"
-            }
-            headers = {
-                "User-Agent": "Mindware_bioterminal",
-                "Accept": "*/*",
-                "Connection": "close"
-            }
-            r = requests.get(adms_url, headers=headers, params=params)
-            response = r.text.strip()
-
-            if r.status_code == 200:
-                logging.info(f"🤝 Handshake successful — Response: {response}")
-            else:
-                logging.warning(f"⚠️ Handshake failed: {r.status_code} - {response}")
-        except Exception as e:
-            logging.exception("💥 Handshake error")
-    
-    def upload_latest_log(self):
-        adms_url = f"{ADMS_URL}/iclock/upload-log"  # adjust if needed
-
-        try:
-            # Ensure log folder exists
-            os.makedirs("logs", exist_ok=True)
-
-            today = datetime.now().strftime("%Y-%m-%d")
-            original_log = "logs/webroster.log"
-            renamed_log = f"logs/webroster-{today}.log"
-
-            # Rotate the log file: rename current and create a new one
-            if os.path.exists(original_log):
-                shutil.copy2(original_log, renamed_log)  # make a copy
-                open(original_log, 'w').close()  # clear the original log
-
-            with open(renamed_log, "rb") as f:
-                headers = {
-                    "User-Agent": "Mindware_bioterminal",
-                    "Accept": "*/*",
-                    "Connection": "close"
-                }
-
-                logging.info(f"📤 Uploading log file: {renamed_log} to {adms_url}")
-                response = requests.post(
-                    adms_url,
-                    files={"file": (os.path.basename(renamed_log), f)},
-                    data={"sn": get_device_sn()},
-                    headers=headers
-                )
-
-            if response.status_code == 200:
-                logging.info("✅ Log file uploaded successfully.")
-                # Optional: delete after upload
-                os.remove(renamed_log)
-            else:
-                logging.warning(f"⚠️ Upload failed: {response.status_code} - {response.text}")
-
-        except Exception as e:
-            logging.exception("💥 Exception during log upload")
-
-            
-    def poll_getrequest(self):
-
-        def get_cpu_temp():
-            try:
-                output = os.popen("vcgencmd measure_temp").readline()
-                return float(output.replace("temp=", "").replace("'C\n", ""))
-            except:
-                return -1
-
-        def get_uptime():
-            try:
-                output = os.popen("uptime -p").readline()
-                return output.strip()
-            except:
-                return "unknown"
-
-        def get_disk_usage():
-            total, used, free = shutil.disk_usage("/")
-            return f"{int(used / total * 100)}%"
-
-        def get_memory_usage():
-            mem = psutil.virtual_memory()
-            return f"{int(mem.percent)}%"
-
-        def get_git_version(path="/home/mindware/webroster-bio"):
-            try:
-                return subprocess.check_output(["git", "-C", path, "rev-parse", "--short", "HEAD"]).decode().strip()
-            except:
-                return "unknown"
-            
-        adms_url = f"{ADMS_URL}/iclock/getrequest"
-        try:
-            now = datetime.utcnow() + timedelta(hours=TIMEZONE_OFFSET)
-            current_time = now.strftime("%Y-%m-%d %H:%M:%S")
-            params = {
-                "SN": SN,
-                "options": "all",
-                "language": "101",
-                "pushver": "3.0.0",
-                "PushOptionsFlag": "1",
-                "ip": socket.gethostbyname(socket.gethostname()),
-                "current_time": current_time,
-                "temp": get_cpu_temp(),
-                "uptime": get_uptime(),
-                "disk": get_disk_usage(),
-                "mem": get_memory_usage(),
-                "gitver": get_git_version()
-            }
-            query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-            url = f"{adms_url}?{query_string}"
-            headers = {
-                "User-Agent": "Mindware_bioterminal",
-                "Accept": "*/*",
-                "Connection": "close",
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-            logging.info(f"🔄 Polling getrequest: {url}")
-            response = requests.get(url, headers=headers)
-            body = response.text.strip()
-
-            if response.status_code == 200:
-                if body.startswith("C:"):
-                    logging.info("📩 Received commands from getrequest")
-                    for line in body.splitlines():
-                        logging.debug(f"📩 Command line: {line}")
-                        if "USERINFO" in line:
-                            self._parse_userinfo_command(line)
-                        elif "CONTROL DEVICE 03000000" in line:
-                            logging.warning("🌀 Restart command received from ADMS. Rebooting now.")
-                            self._execute_restart()
-                else:
-                    logging.info("🕊️ No pending commands")
-            else:
-                logging.warning(f"⚠️ getrequest failed: {response.status_code} - {body}")
-        except Exception as e:
-            logging.exception("💥 Error during getrequest polling")
-    
-    def push_unsynced_logs(self):
-        def push():
-            adms_url = f"{ADMS_URL}/iclock/cdata?SN={SN}&table=ATTLOG"
-            logs = self.db.get_unsynced_attlogs()
-            if not logs:
-                self.update_status("☁️ No new events to push.")
-                return
-
-            lines = ["ATTLOG"]
-            for log in logs:
-                _, user_id, timestamp = log
-                lines.append(f"{user_id}\t{timestamp}\t0\t0\t0")
-
-            payload = "\n".join(lines)
-            headers = {
-                "User-Agent": "Mindware_bioterminal",
-                "Content-Type": "text/plain",
-                "Accept": "*/*",
-                "Connection": "close"
-            }
-
-            try:
-                logging.info(f"🛰️ POSTing to: {adms_url}")
-                logging.debug(f"📦 Payload:\n{payload}")
-
-                response = requests.post(adms_url, data=payload, headers=headers)
-                response_text = response.text.strip()
-
-                logging.info(f"✅ Response Code: {response.status_code}")
-                logging.debug(f"📩 Response Body:\n{response_text}")
-
-                if response.status_code == 200:
-                    for log in logs:
-                        self.db.mark_event_synced(log[0])
-                    self.update_status(f"✅ Synced {len(logs)} events.")
-                    
-                    # Handle remote commands if returned
-                    if response_text.startswith("C:"):
-                        for line in response_text.splitlines():
-                            if "USERINFO" in line:
-                                self._parse_userinfo_command(line)
-                else:
-                    self.update_status(f"❌ Push failed: {response.status_code} - {response.text}")
-
-            except Exception as e:
-                self.update_status("📴 Offline: sync failed")
-                logging.warning(f"Sync failed due to: {e}")
-
-        threading.Thread(target=push, daemon=True).start()
-
-    def _parse_userinfo_command(self, line):
-        try:
-            if "USERINFO" not in line:
-                return
-
-            # Remove the prefix up to "USERINFO" and split the rest by tabs
-            data_part = line.split("USERINFO", 1)[-1].strip()
-            tokens = dict(token.split("=", 1) for token in data_part.split("\t") if "=" in token)
-
-            idagente = int(tokens.get("PIN", "0").strip())
-            name = tokens.get("Name", "").strip()
-            idempresa = int(tokens.get("IDEmpresa", 1))
-            idoficina = int(tokens.get("IDOficina", 1))
-
-            self.db.add_user(idempresa, idoficina, idagente, name)
-            logging.info(f"✅ Updated user info: {idagente} - {name}")
-
-        except Exception as e:
-            logging.exception(f"💥 Failed to parse USERINFO command: {line}")
-
-
-    def _execute_restart(self):
-        try:
-            logging.info("🔁 Rebooting device...")
-            subprocess.Popen(['sudo', '/sbin/reboot'])
-        except Exception as e:
-            logging.exception("💥 Failed to reboot the device.")
\ No newline at end of file
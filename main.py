@@ -1,7 +1,6 @@
 import os
 import sys
 import time
-import json
 import uuid
 import psutil
 import shutil
@@ -18,17 +17,39 @@ from tkinter import messagebox
 import tkinter as tk
 from PIL import Image, ImageTk
 from fingerprint_manager import FingerprintManager
+from db import local_datetime
+from config import CONFIG, get_device_sn
+from metrics import METRICS, METRICS_FILE
+
+app = None
 
 def graceful_exit(signum, frame):
     print("🛑 Caught signal, exiting...")
+    try:
+        if app:
+            app.fingerprint.shutdown()
+    except Exception:
+        logging.exception("💥 Error flushing pending events on exit")
+    try:
+        METRICS.dump(METRICS_FILE)
+    except Exception:
+        logging.exception("💥 Error writing metrics on exit")
     try:
         root.destroy()
     except:
         pass
     sys.exit(0)
 
+def dump_metrics(signum=None, frame=None):
+    """kill -USR1 <pid>: escribe logs/metrics.json y deja el resumen en el log."""
+    try:
+        METRICS.log_summary(METRICS.dump(METRICS_FILE))
+    except Exception:
+        logging.exception("💥 Error writing metrics")
+
 signal.signal(signal.SIGINT, graceful_exit)
 signal.signal(signal.SIGTERM, graceful_exit)
+signal.signal(signal.SIGUSR1, dump_metrics)
 
 # Create logs folder
 os.makedirs("logs", exist_ok=True)
@@ -50,19 +71,6 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
-with open(os.path.join(os.path.dirname(__file__), "config.json")) as f:
-    CONFIG = json.load(f)
-
-def get_device_sn(prefix="WBIO"):
-    try:
-        with open('/proc/cpuinfo', 'r') as f:
-            for line in f:
-                if line.startswith('Serial'):
-                    serial = line.strip().split(":")[1].strip()
-                    return f"{prefix}{serial[-6:].upper()}"
-    except Exception as e:
-        return f"{prefix}000000"    
-    
 def get_cpu_temp():
     try:
         output = os.popen("vcgencmd measure_temp").readline()
@@ -105,6 +113,7 @@ def get_local_ip():
 SN=get_device_sn()
 
 TIMEZONE_OFFSET = CONFIG.get("TIMEZONE_OFFSET", -6)
+METRICS_DUMP_INTERVAL_SECONDS = CONFIG.get("METRICS_DUMP_INTERVAL_SECONDS", 300)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -135,7 +144,8 @@ class AttendanceApp:
         self.root.bind("<Key>", self.reset_idle_timer)
 
         self.fingerprint = FingerprintManager(update_callback=self.update_status)
-        self.fingerprint.refresh_history = self.update_attendance_history
+        # Lo llama el hilo de EventWriter: el refresco se pasa al loop de Tk
+        self.fingerprint.refresh_history = lambda: self.root.after(0, self.update_attendance_history)
 
         self.status_label = tk.Label(
                 root,
@@ -186,6 +196,15 @@ class AttendanceApp:
             tk.Button(root, text="Exit", font=("Arial", 12), command=root.quit).place(x=400, y=10)
 
         self.root.after(1000, self.check_idle_timeout)
+        self.root.after(METRICS_DUMP_INTERVAL_SECONDS * 1000, self._dump_metrics_periodically)
+
+    def _dump_metrics_periodically(self):
+        # El proceso de sync sube este archivo junto con el log diario
+        try:
+            METRICS.dump(METRICS_FILE)
+        except Exception:
+            logging.exception("💥 Error writing metrics")
+        self.root.after(METRICS_DUMP_INTERVAL_SECONDS * 1000, self._dump_metrics_periodically)
 
     def play_sound(self, filename):
         try:
@@ -209,9 +228,24 @@ class AttendanceApp:
                 continue
         return False
     
+    def get_sync_status(self):
+        """Texto del indicador: servicio caído, ADMS en backoff (circuit breaker) o en línea."""
+        if not self.is_sync_service_running():
+            return "Offline!"
+        link = self.fingerprint.db.get_adms_link()
+        if link and link[0] == "open":
+            return f"Retry {max(0, link[1] - int(time.time()))}s"
+        if link and link[0] == "half-open":
+            return "Retrying"
+        return "Sync"
+
+    @staticmethod
+    def sync_status_color(status):
+        return "green" if status == "Sync" else "orange" if status.startswith("Retry") else "red"
+
     def update_sync_status_icon(self):
-        running = self.is_sync_service_running()
-        self.sync_status_icon.config(text="Sync" if running else "Offline!", fg="green" if running else "red")
+        status = self.get_sync_status()
+        self.sync_status_icon.config(text=status, fg=self.sync_status_color(status))
         self.root.after(10000, self.update_sync_status_icon)  # Check every 10 seconds
     
     def check_idle_timeout(self):
@@ -348,17 +382,15 @@ class AttendanceApp:
         self.status_label.config(text="Listo para escanear huellas...")
 
     def get_user_list(self):
-        users = self.fingerprint.db.conn.execute("SELECT idagente, name FROM users ORDER BY name").fetchall()
         enriched = []
 
-        for idagente, name in users:
-            finger_ids = self.fingerprint.db.get_finger_ids_by_user(idagente)
-            if finger_ids:
+        for idagente, name, fingerprint_count in self.fingerprint.db.get_users_with_fingerprint_counts():
+            if fingerprint_count:
                 status = "✅"
             else:
                 status = "❌"
             display = f"{status} {name}"
-            enriched.append((idagente, display))
+            enriched.append((idagente, display, fingerprint_count))
 
         return enriched
 
@@ -374,14 +406,10 @@ class AttendanceApp:
 
         self.history_labels.clear()
 
-        rows = self.fingerprint.db.conn.execute(
-            "SELECT u.name, e.timestamp FROM events e "
-            "JOIN users u ON u.idagente = e.user_id "
-            "ORDER BY e.timestamp DESC LIMIT 3"
-        ).fetchall()
+        rows = self.fingerprint.db.get_recent_events(limit=3)
 
-        for i, (name, ts) in enumerate(reversed(rows)):
-            time_str = ts.split("T")[1][:5]  # HH:MM
+        for i, (_, _, name, ts_epoch, utc_offset, _) in enumerate(reversed(rows)):
+            time_str = local_datetime(ts_epoch, utc_offset).strftime("%H:%M")
             text = f"✅ {name} — {time_str}"
 
             label = tk.Label(self.history_box, text=text, font=("Arial", 14),
@@ -456,8 +484,9 @@ class AttendanceApp:
         def get_system_status():
             try:
 
-                used = self.fingerprint.db.count_all_fingerprints()
-                max_capacity = 127
+                used = self.fingerprint.db.count_used_slots()
+                max_capacity = self.fingerprint.capacity
+                host_only = self.fingerprint.db.count_all_fingerprints() - used
 
                 return {
                     "Serial No": f"{get_device_sn()}",
@@ -467,8 +496,9 @@ class AttendanceApp:
                     "Uptime": get_uptime(),
                     "IP": get_local_ip(),
                     "Version": get_git_version(),
-                    "Sync": "Sync" if self.is_sync_service_running() else "Offline!",
-                    "Fingerprints": f"{used} / {max_capacity}"
+                    "Sync": self.get_sync_status(),
+                    "Fingerprints": f"{used} / {max_capacity}",
+                    "Host only": str(host_only),
                 }
             except Exception as e:
                 return {"Error": str(e)}
@@ -481,7 +511,7 @@ class AttendanceApp:
                     if key in labels:
                         labels[key].config(text=f"{key}: {val}")
                         if key == "Sync":
-                            labels[key].config(fg="green" if val == "Sync" else "red")
+                            labels[key].config(fg=self.sync_status_color(val))
                         elif key == "Fingerprints":
                             try:
                                 count, maxval = map(int, val.split("/"))
@@ -497,7 +527,7 @@ class AttendanceApp:
                 print("Status update error:", e)
 
         labels = {}
-        for k in ["Serial No", "CPU Temp", "Memory", "Disk", "Uptime", "IP", "Version", "Sync", "Fingerprints"]:
+        for k in ["Serial No", "CPU Temp", "Memory", "Disk", "Uptime", "IP", "Version", "Sync", "Fingerprints", "Host only"]:
             labels[k] = tk.Label(status_frame, text=f"{k}: ...", anchor="w", font=("Arial", 10))
             labels[k].pack(anchor="w")
 
@@ -547,7 +577,7 @@ class AttendanceApp:
             {
                 "idagente": u[0],
                 "name": u[1],
-                "has_fp": self.fingerprint.db.count_fingerprints_by_user(u[0]) > 0
+                "has_fp": u[2] > 0
             }
             for u in self.get_user_list()
         ]
@@ -581,7 +611,7 @@ class AttendanceApp:
         def start_enroll():
             idagente = get_selected_user()
             if idagente:
-                agente_name = self.fingerprint.db.get_user(idagente)[1]
+                agente_name = self.fingerprint.db.get_user(idagente)[3]
                 user_win.grab_release()
                 user_win.destroy()
                 self.child_windows.remove(user_win)
@@ -775,8 +805,9 @@ if __name__ == "__main__":
     root = tk.Tk()
     root.withdraw()  # Hide main window initially
     def start_app():
+        global app
         root.deiconify()  # Show main window
-        AttendanceApp(root)
+        app = AttendanceApp(root)
 
     root.after(2000, start_app)
     root.mainloop()
\ No newline at end of file
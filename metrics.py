@@ -0,0 +1,97 @@
+# metrics.py
+#
+# Tiempos por etapa del pipeline de checada y enrolamiento. Cada etapa guarda
+# sus últimas muestras (time.monotonic, en segundos) en memoria; los
+# percentiles se calculan solo al pedir un snapshot, así medir cuesta un
+# append. main.py escribe el snapshot en logs/metrics.json cada cierto tiempo,
+# al recibir SIGUSR1 y al salir; upload_latest_log lo adjunta al log diario.
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_MAX_SAMPLES = 2048
+METRICS_FILE = "logs/metrics.json"
+
+
+class Histogram:
+    """Últimas max_samples muestras más totales acumulados desde el arranque."""
+
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": round(percentile(50) * 1000, 2),
+            "p95_ms": round(percentile(95) * 1000, 2),
+            "p99_ms": round(percentile(99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class Metrics:
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.max_samples)
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def snapshot(self):
+        with self._lock:
+            stages = {name: h.summary() for name, h in sorted(self._histograms.items())}
+        return {"since": int(self.started_at), "at": int(time.time()), "stages": stages}
+
+    def dump(self, path=METRICS_FILE):
+        """Escribe el snapshot como JSON (reemplazo atómico) y lo devuelve."""
+        snapshot = self.snapshot()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, path)
+        return snapshot
+
+    def log_summary(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        for name, s in snapshot["stages"].items():
+            logging.info(f"⏱️ {name}: n={s['count']} p50={s['p50_ms']}ms "
+                         f"p95={s['p95_ms']}ms p99={s['p99_ms']}ms max={s['max_ms']}ms")
+
+
+METRICS = Metrics()
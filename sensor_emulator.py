@@ -0,0 +1,531 @@
+# sensor_emulator.py
+#
+# Emulador de un lector R30x/R503 sobre un pseudo-terminal. Habla el mismo
+# protocolo de paquetes que adafruit_fingerprint (EF01 + dirección + tipo +
+# longitud + payload + checksum), así que FingerprintManager(port=emu.port)
+# corre sin cambios: sondeo y negociación de velocidad, búsqueda, enrolamiento,
+# descarga/subida de templates, etc.
+#
+#     with SensorEmulator(library_size=200, latency_scale=0) as emu:
+#         emu.enroll(0, "alice")
+#         manager = FingerprintManager(port=emu.port)
+#         emu.press("alice", duration=0.5)
+#
+# Los "dedos" son nombres: cada uno produce un template determinista de 512
+# bytes cuyos primeros SIGNATURE_BYTES lo identifican; dos capturas del mismo
+# dedo coinciden aunque el resto varíe con capture_noise.
+import argparse
+import fcntl
+import hashlib
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+from collections import Counter
+
+STARTCODE = b"\xef\x01"
+ADDRESS = b"\xff\xff\xff\xff"
+COMMAND_PACKET = 0x01
+DATA_PACKET = 0x02
+ACK_PACKET = 0x07
+END_DATA_PACKET = 0x08
+
+OK = 0x00
+PACKETRECIEVEERR = 0x01
+NOFINGER = 0x02
+IMAGEFAIL = 0x03
+FEATUREFAIL = 0x07
+NOMATCH = 0x08
+NOTFOUND = 0x09
+ENROLLMISMATCH = 0x0A
+BADLOCATION = 0x0B
+DBRANGEFAIL = 0x0C
+UPLOADFAIL = 0x0F
+MODULEOK = 0x55
+
+# inject_failure(command, DROP) → el sensor no responde (timeout en el host)
+DROP = None
+
+TEMPLATE_BYTES = 512
+SIGNATURE_BYTES = 32
+PACKET_SIZES = {0: 32, 1: 64, 2: 128, 3: 256}
+TCGETS2 = 0x802C542A  # Linux: termios2 con la velocidad real del lado esclavo
+
+COMMANDS = {
+    0x01: "get_image",
+    0x02: "image_2_tz",
+    0x03: "match",
+    0x04: "search",
+    0x05: "reg_model",
+    0x06: "store",
+    0x07: "load",
+    0x08: "upload",
+    0x09: "download",
+    0x0C: "delete",
+    0x0D: "empty",
+    0x0E: "set_sysparam",
+    0x0F: "read_sysparam",
+    0x13: "verify_password",
+    0x1B: "fast_search",
+    0x1D: "template_count",
+    0x1F: "template_read",
+    0x35: "set_led",
+    0x3D: "soft_reset",
+    0x53: "check_module",
+}
+
+# Tiempos aproximados de un R307 en segundos; la búsqueda cuesta además por página recorrida
+DEFAULT_LATENCY = {
+    "get_image": 0.10,
+    "image_2_tz": 0.08,
+    "reg_model": 0.05,
+    "store": 0.03,
+    "delete": 0.02,
+    "match": 0.01,
+    "search": 0.005,
+    "fast_search": 0.005,
+}
+DEFAULT_SEARCH_PER_PAGE = {"search": 0.001, "fast_search": 0.0003}
+
+
+def finger_template(finger, noise=0, rng=None):
+    """Template determinista del dedo; noise bytes fuera de la firma se alteran al azar."""
+    data = bytearray()
+    counter = 0
+    while len(data) < TEMPLATE_BYTES:
+        data += hashlib.sha256(f"{finger}:{counter}".encode()).digest()
+        counter += 1
+    data = data[:TEMPLATE_BYTES]
+    rng = rng or random
+    for _ in range(noise):
+        data[rng.randrange(SIGNATURE_BYTES, TEMPLATE_BYTES)] ^= rng.randrange(1, 256)
+    return bytes(data)
+
+
+def same_finger(a, b):
+    return a is not None and b is not None and a[:SIGNATURE_BYTES] == b[:SIGNATURE_BYTES]
+
+
+class SensorEmulator:
+    def __init__(self, library_size=200, baudrate=57600, latency=None, latency_scale=1.0,
+                 search_per_page=None, simulate_wire=False, failures=None,
+                 capture_noise=8, packet_size_code=2, seed=None):
+        """
+        latency          → {comando: segundos}, se combina con DEFAULT_LATENCY
+        latency_scale    → multiplica todas las latencias (0 = sin esperas, para CI)
+        search_per_page  → {"search"/"fast_search": segundos por página recorrida}
+        simulate_wire    → espera lo que tardarían los bytes en el cable a la velocidad actual
+        failures         → {comando: probabilidad} de responder con un código de error
+        """
+        self.library_size = library_size
+        self.baudrate = baudrate
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.latency_scale = latency_scale
+        self.search_per_page = {**DEFAULT_SEARCH_PER_PAGE, **(search_per_page or {})}
+        self.simulate_wire = simulate_wire
+        self.failures = dict(failures or {})
+        self.capture_noise = capture_noise
+        self.packet_size_code = packet_size_code
+        self.security_level = 3
+        self.rng = random.Random(seed)
+
+        self.library = {}
+        self.buffers = {1: None, 2: None}
+        self.image = None
+        self.stats = Counter()
+
+        self._presses = []
+        self._forced = {}
+        self._download = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._master = None
+        self._slave = None
+        self.port = None
+
+    # ---------------------------------------------------------------------
+    #  Ciclo de vida
+    # ---------------------------------------------------------------------
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        logging.info(f"🧪 Sensor emulator listening on {self.port}")
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=1)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ---------------------------------------------------------------------
+    #  Guion de la prueba
+    # ---------------------------------------------------------------------
+    def enroll(self, page, finger):
+        """Carga directamente el template de `finger` en la librería."""
+        with self._lock:
+            self.library[page] = finger_template(finger)
+
+    def press(self, finger, duration=0.5, delay=0.0):
+        """El dedo queda sobre el lector de now + delay a now + delay + duration."""
+        start = time.monotonic() + delay
+        with self._lock:
+            self._presses.append((start, start + duration, finger))
+
+    def script(self, presses):
+        """presses → [(delay, finger, duration), ...] relativos al momento de la llamada."""
+        for delay, finger, duration in presses:
+            self.press(finger, duration=duration, delay=delay)
+
+    def inject_failure(self, command, code=DROP, count=1):
+        """Las próximas `count` llamadas a `command` responden `code` (DROP = sin respuesta)."""
+        with self._lock:
+            self._forced.setdefault(command, []).extend([code] * count)
+
+    def finger_present(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._presses = [p for p in self._presses if p[1] > now]
+            for start, end, finger in self._presses:
+                if start <= now < end:
+                    return finger
+        return None
+
+    # ---------------------------------------------------------------------
+    #  Transporte
+    # ---------------------------------------------------------------------
+    def _host_baudrate(self):
+        try:
+            raw = fcntl.ioctl(self._master, TCGETS2, bytes(44))
+            return struct.unpack_from("I", raw, 40)[0]
+        except OSError:
+            return None
+
+    def _serve(self):
+        buffer = bytearray()
+        while self._running:
+            try:
+                ready, _, _ = select.select([self._master], [], [], 0.05)
+                if not ready:
+                    continue
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                break
+
+            host_baud = self._host_baudrate()
+            if host_baud is not None and host_baud != self.baudrate:
+                # Velocidades distintas: en un UART real llegaría basura
+                buffer.clear()
+                continue
+            if self.simulate_wire:
+                time.sleep(len(chunk) * 10 / self.baudrate)
+
+            buffer += chunk
+            while True:
+                packet = self._take_packet(buffer)
+                if packet is None:
+                    break
+                self._dispatch(*packet)
+
+    @staticmethod
+    def _take_packet(buffer):
+        start = buffer.find(STARTCODE)
+        if start < 0:
+            buffer.clear()
+            return None
+        del buffer[:start]
+        if len(buffer) < 9:
+            return None
+        packet_type, length = struct.unpack(">BH", buffer[6:9])
+        if len(buffer) < 9 + length:
+            return None
+        payload = bytes(buffer[9:9 + length - 2])
+        checksum = struct.unpack(">H", buffer[7 + length:9 + length])[0]
+        del buffer[:9 + length]
+        valid = (packet_type + (length >> 8) + (length & 0xFF) + sum(payload)) & 0xFFFF == checksum
+        return packet_type, payload, valid
+
+    def _write(self, data):
+        if self.simulate_wire:
+            time.sleep(len(data) * 10 / self.baudrate)
+        view = memoryview(data)
+        while view:
+            written = os.write(self._master, view)
+            view = view[written:]
+
+    def _send(self, packet_type, payload):
+        length = len(payload) + 2
+        checksum = (packet_type + (length >> 8) + (length & 0xFF) + sum(payload)) & 0xFFFF
+        self._write(STARTCODE + ADDRESS + struct.pack(">BH", packet_type, length)
+                    + bytes(payload) + struct.pack(">H", checksum))
+
+    def _ack(self, *payload):
+        self._send(ACK_PACKET, bytes(payload))
+
+    def _wait(self, name, pages=0):
+        delay = self.latency.get(name, 0) + self.search_per_page.get(name, 0) * pages
+        if delay and self.latency_scale:
+            time.sleep(delay * self.latency_scale)
+
+    def _failure(self, name):
+        """Código forzado o aleatorio para este comando; False si debe ejecutarse normal."""
+        with self._lock:
+            forced = self._forced.get(name)
+            if forced:
+                return forced.pop(0)
+        probability = self.failures.get(name, 0)
+        if probability and self.rng.random() < probability:
+            return PACKETRECIEVEERR if name not in ("get_image", "image_2_tz") else IMAGEFAIL
+        return False
+
+    # ---------------------------------------------------------------------
+    #  Comandos
+    # ---------------------------------------------------------------------
+    def _dispatch(self, packet_type, payload, valid):
+        if packet_type in (DATA_PACKET, END_DATA_PACKET):
+            self._receive_data(packet_type, payload)
+            return
+        if not valid:
+            self._ack(PACKETRECIEVEERR)
+            return
+        if packet_type != COMMAND_PACKET or not payload:
+            return
+
+        name = COMMANDS.get(payload[0])
+        self.stats[name or f"0x{payload[0]:02x}"] += 1
+        if name is None:
+            self._ack(PACKETRECIEVEERR)
+            return
+
+        failure = self._failure(name)
+        if failure is DROP:
+            return
+        if failure is not False:
+            self._wait(name)
+            self._ack(failure, *([0] * self._reply_padding(name)))
+            return
+
+        getattr(self, f"_cmd_{name}")(payload[1:])
+
+    @staticmethod
+    def _reply_padding(name):
+        # Un error conserva el tamaño de respuesta que espera la librería
+        return {"search": 4, "fast_search": 4, "match": 2, "template_count": 2,
+                "read_sysparam": 16, "template_read": 32}.get(name, 0)
+
+    def _cmd_verify_password(self, args):
+        self._ack(OK)
+
+    def _cmd_check_module(self, args):
+        self._ack(MODULEOK)
+
+    def _cmd_set_led(self, args):
+        self._ack(OK)
+
+    def _cmd_soft_reset(self, args):
+        self._ack(OK)
+        self._write(bytes([MODULEOK]))
+
+    def _cmd_read_sysparam(self, args):
+        self._ack(OK, *struct.pack(">HHHH4sHH", 0, 0x0009, self.library_size, self.security_level,
+                                   ADDRESS, self.packet_size_code, self.baudrate // 9600))
+
+    def _cmd_set_sysparam(self, args):
+        param, value = args[0], args[1]
+        if param == 4 and 1 <= value <= 12:
+            self._ack(OK)
+            # El módulo contesta a la velocidad vieja y cambia después
+            self.baudrate = 9600 * value
+        elif param == 5 and 1 <= value <= 5:
+            self.security_level = value
+            self._ack(OK)
+        elif param == 6 and value in PACKET_SIZES:
+            self.packet_size_code = value
+            self._ack(OK)
+        else:
+            self._ack(PACKETRECIEVEERR)
+
+    def _cmd_get_image(self, args):
+        self._wait("get_image")
+        finger = self.finger_present()
+        if finger is None:
+            self._ack(NOFINGER)
+            return
+        self.image = finger
+        self._ack(OK)
+
+    def _cmd_image_2_tz(self, args):
+        self._wait("image_2_tz")
+        if self.image is None:
+            self._ack(FEATUREFAIL)
+            return
+        self.buffers[args[0] if args[0] in (1, 2) else 2] = finger_template(
+            self.image, self.capture_noise, self.rng)
+        self._ack(OK)
+
+    def _cmd_reg_model(self, args):
+        self._wait("reg_model")
+        if not same_finger(self.buffers[1], self.buffers[2]):
+            self._ack(ENROLLMISMATCH)
+            return
+        self.buffers[2] = self.buffers[1]
+        self._ack(OK)
+
+    def _cmd_store(self, args):
+        self._wait("store")
+        slot, page = args[0], struct.unpack(">H", args[1:3])[0]
+        template = self.buffers.get(slot if slot in (1, 2) else 2)
+        if page >= self.library_size or template is None:
+            self._ack(BADLOCATION)
+            return
+        with self._lock:
+            self.library[page] = template
+        self._ack(OK)
+
+    def _cmd_load(self, args):
+        slot, page = args[0], struct.unpack(">H", args[1:3])[0]
+        with self._lock:
+            template = self.library.get(page)
+        if template is None:
+            self._ack(DBRANGEFAIL)
+            return
+        self.buffers[slot if slot in (1, 2) else 2] = template
+        self._ack(OK)
+
+    def _cmd_delete(self, args):
+        self._wait("delete")
+        page, count = struct.unpack(">HH", args[:4])
+        if page + count > self.library_size:
+            self._ack(BADLOCATION)
+            return
+        with self._lock:
+            for p in range(page, page + count):
+                self.library.pop(p, None)
+        self._ack(OK)
+
+    def _cmd_empty(self, args):
+        with self._lock:
+            self.library.clear()
+        self._ack(OK)
+
+    def _search(self, name, args):
+        slot, start, count = args[0], *struct.unpack(">HH", args[1:5])
+        probe = self.buffers.get(slot if slot in (1, 2) else 2)
+        end = min(start + count, self.library_size)
+        with self._lock:
+            library = dict(self.library)
+
+        scanned = 0
+        for page in range(start, end):
+            scanned += 1
+            if same_finger(library.get(page), probe):
+                self._wait(name, scanned)
+                self._ack(OK, page >> 8, page & 0xFF, 0, 150)
+                return
+        self._wait(name, scanned)
+        self._ack(NOTFOUND, 0, 0, 0, 0)
+
+    def _cmd_search(self, args):
+        self._search("search", args)
+
+    def _cmd_fast_search(self, args):
+        self._search("fast_search", args)
+
+    def _cmd_match(self, args):
+        self._wait("match")
+        if same_finger(self.buffers[1], self.buffers[2]):
+            self._ack(OK, 0, 150)
+        else:
+            self._ack(NOMATCH, 0, 0)
+
+    def _cmd_template_count(self, args):
+        with self._lock:
+            count = len(self.library)
+        self._ack(OK, count >> 8, count & 0xFF)
+
+    def _cmd_template_read(self, args):
+        index = bytearray(32)
+        base = args[0] * 256
+        with self._lock:
+            for page in self.library:
+                if base <= page < base + 256:
+                    index[(page - base) // 8] |= 1 << ((page - base) % 8)
+        self._ack(OK, *index)
+
+    def _cmd_upload(self, args):
+        template = self.buffers.get(args[0] if args[0] in (1, 2) else 2)
+        if template is None:
+            self._ack(UPLOADFAIL)
+            return
+        self._ack(OK)
+        size = PACKET_SIZES[self.packet_size_code]
+        for offset in range(0, len(template), size):
+            last = offset + size >= len(template)
+            self._send(END_DATA_PACKET if last else DATA_PACKET, template[offset:offset + size])
+
+    def _cmd_download(self, args):
+        self._download = (args[0] if args[0] in (1, 2) else 2, bytearray())
+        self._ack(OK)
+
+    def _receive_data(self, packet_type, payload):
+        if self._download is None:
+            return
+        slot, data = self._download
+        data += payload
+        if packet_type == END_DATA_PACKET:
+            self.buffers[slot] = bytes(data)
+            self._download = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="R30x fingerprint sensor emulator on a pseudo-terminal")
+    parser.add_argument("--library-size", type=int, default=200)
+    parser.add_argument("--baud", type=int, default=57600)
+    parser.add_argument("--enroll", action="append", default=[], metavar="SLOT:FINGER")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--simulate-wire", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    emu = SensorEmulator(args.library_size, args.baud, latency_scale=args.latency_scale,
+                         simulate_wire=args.simulate_wire)
+    for spec in args.enroll:
+        slot, finger = spec.split(":", 1)
+        emu.enroll(int(slot), finger)
+
+    with emu:
+        print(f"Sensor emulator on {emu.port}")
+        print("Commands: press <finger> [seconds] | quit")
+        try:
+            while True:
+                words = input("> ").split()
+                if not words:
+                    continue
+                if words[0] == "quit":
+                    break
+                if words[0] == "press" and len(words) >= 2:
+                    emu.press(words[1], duration=float(words[2]) if len(words) > 2 else 0.5)
+        except (EOFError, KeyboardInterrupt):
+            pass
+
+
+if __name__ == "__main__":
+    main()
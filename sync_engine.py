@@ -0,0 +1,116 @@
+# sync_engine.py
+#
+# Motor de sync con asyncio: cada trabajo (push de ATTLOG, getrequest, log
+# diario, mantenimiento) es una tarea independiente con su propia cadencia y
+# su propio timeout. Las llamadas bloqueantes (HTTP, SQLite) corren en un
+# executor por prioridad, así que un log grande o una compactación nunca
+# dejan a un push de checadas esperando en la misma cola.
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from metrics import METRICS
+
+PRIORITY_REALTIME = 0  # checadas: lo que el servidor debe ver cuanto antes
+PRIORITY_CONTROL = 1   # getrequest: comandos y altas de usuarios
+PRIORITY_BULK = 2      # log diario, compactación, actualizaciones
+
+# Lo devuelve una tarea que decidió no correr (p. ej. ADMS en backoff): una
+# tarea diaria lo vuelve a intentar en la siguiente revisión
+SKIPPED = object()
+
+
+class SyncTask:
+    """
+    fn        → callable bloqueante; corre en el executor de su prioridad
+    interval  → segundos entre corridas (o entre revisiones si daily=True)
+    timeout   → segundos que el motor espera una corrida antes de seguir
+    daily     → corre una vez por fecha (la primera revisión de cada día)
+    """
+
+    def __init__(self, name, fn, interval, timeout, priority=PRIORITY_BULK, daily=False):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.timeout = timeout
+        self.priority = priority
+        self.daily = daily
+        self.last_day = None
+        self._pending = None
+        self._wake = None
+
+
+class SyncEngine:
+    def __init__(self, tasks):
+        self.tasks = {task.name: task for task in tasks}
+        self._executors = {
+            priority: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sync-p{priority}")
+            for priority in {task.priority for task in tasks}
+        }
+        self._loop = None
+        self._stopped = None
+
+    def wake(self, name):
+        """Adelanta la siguiente corrida de una tarea; se puede llamar desde cualquier hilo."""
+        task = self.tasks[name]
+        if self._loop and task._wake:
+            self._loop.call_soon_threadsafe(task._wake.set)
+
+    def stop(self):
+        if self._loop and self._stopped:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        for task in self.tasks.values():
+            task._wake = asyncio.Event()
+
+        runners = [asyncio.create_task(self._run_task(task), name=task.name) for task in self.tasks.values()]
+        logging.info(f"🔄 Sync engine started: {', '.join(self.tasks)}")
+        try:
+            await self._stopped.wait()
+        finally:
+            for runner in runners:
+                runner.cancel()
+            await asyncio.gather(*runners, return_exceptions=True)
+            for executor in self._executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+            logging.info("🛑 Sync engine stopped.")
+
+    async def _run_task(self, task):
+        while True:
+            if not task.daily or task.last_day != date.today():
+                await self._run_once(task)
+
+            try:
+                await asyncio.wait_for(task._wake.wait(), timeout=task.interval)
+            except asyncio.TimeoutError:
+                pass
+            task._wake.clear()
+
+    async def _run_once(self, task):
+        if task._pending is not None and not task._pending.done():
+            # La corrida anterior pasó su timeout y sigue en su hilo: no se encola otra
+            logging.warning(f"⏳ Sync task '{task.name}' still running, skipping this turn")
+            return
+
+        today = date.today()
+        start = time.monotonic()
+        future = self._loop.run_in_executor(self._executors[task.priority], task.fn)
+        task._pending = future
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=task.timeout)
+        except asyncio.TimeoutError:
+            METRICS.record(f"sync.{task.name}.timeout", time.monotonic() - start)
+            logging.warning(f"⏱️ Sync task '{task.name}' exceeded {task.timeout}s")
+            return
+        except Exception:
+            logging.exception(f"💥 Sync task '{task.name}' failed")
+        else:
+            if future.result() is SKIPPED:
+                return
+            task.last_day = today
+        METRICS.record(f"sync.{task.name}", time.monotonic() - start)
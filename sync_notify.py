@@ -0,0 +1,84 @@
+# sync_notify.py
+#
+# Aviso local UI → sync_service: cuando el EventWriter confirma checadas, la
+# UI manda un datagrama de un byte a un socket Unix y el sync despierta la
+# tarea "push" de inmediato, en vez de esperar su intervalo. El aviso no lleva
+# datos (los eventos ya están en attendance.db) y se pierde sin problema: si
+# el sync no está escuchando, el intervalo de push sigue como red de seguridad.
+# Una ráfaga de avisos se fusiona: despertar una tarea que ya está despierta
+# o corriendo no encola más que una corrida extra.
+import os
+import socket
+import logging
+
+from config import CONFIG
+
+# Relativo a la carpeta del programa, no al directorio de trabajo: la unidad
+# de la UI no fija WorkingDirectory y los dos procesos deben ver el mismo archivo
+SYNC_NOTIFY_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  CONFIG.get("SYNC_NOTIFY_SOCKET", "sync-notify.sock"))
+
+
+class SyncNotifier:
+    """Lado de la UI: notify() nunca bloquea ni lanza."""
+
+    def __init__(self, path=SYNC_NOTIFY_SOCKET):
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+    def notify(self):
+        try:
+            self._sock.sendto(b"E", self.path)
+        except BlockingIOError:
+            pass  # el buffer del sync ya tiene avisos sin leer: este se fusiona con ellos
+        except OSError:
+            pass  # sync_service no está escuchando; el intervalo de push lo cubre
+
+    def close(self):
+        self._sock.close()
+
+
+class SyncListener:
+    """Lado del sync: lee los avisos dentro del loop de asyncio y llama on_notify() una vez por lote."""
+
+    def __init__(self, on_notify, path=SYNC_NOTIFY_SOCKET):
+        self.on_notify = on_notify
+        self.path = path
+        self._sock = None
+        self._loop = None
+
+    def start(self, loop):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # socket de una corrida anterior
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        self._loop = loop
+        loop.add_reader(self._sock.fileno(), self._drain)
+        logging.info(f"📨 Listening for check-in notifications on {self.path}")
+
+    def _drain(self):
+        received = 0
+        while True:
+            try:
+                self._sock.recv(64)
+            except BlockingIOError:
+                break
+            except OSError:
+                logging.exception("💥 Sync notification socket error")
+                break
+            received += 1
+        if received:
+            self.on_notify()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,10 +1,12 @@
-import time
+import asyncio
 import logging
-import socket
 import os
 import subprocess
-from datetime import datetime
-from fingerprint_manager import FingerprintManager
+from config import CONFIG
+from db import LocalDB
+from adms_client import ADMSClient
+from sync_notify import SyncListener
+from sync_engine import SyncEngine, SyncTask, SKIPPED, PRIORITY_REALTIME, PRIORITY_CONTROL
 
 # Setup logging
 logging.basicConfig(
@@ -17,13 +19,6 @@ logging.basicConfig(
 def log_status(message):
     logging.info(message)
 
-def is_online():
-    try:
-        socket.create_connection(("8.8.8.8", 53), timeout=2)
-        return True
-    except OSError:
-        return False
-
 def run_git_update():
     try:
         logging.info("🔍 Checking for firmware updates...")
@@ -43,44 +38,94 @@ def run_git_update():
         logging.warning(f"❌ Update failed: {e}")
         return False
 
-# Constants
-INTERVAL_SECONDS = 20  # 20 seconds
+# Constants: cadencia (intervalo) y tiempo máximo de cada tarea del motor de sync
+PUSH_INTERVAL_SECONDS = CONFIG.get("PUSH_INTERVAL_SECONDS", 120)  # red de seguridad; la UI avisa cada checada
+PUSH_TIMEOUT_SECONDS = CONFIG.get("PUSH_TIMEOUT_SECONDS", 120)
+POLL_INTERVAL_SECONDS = CONFIG.get("POLL_INTERVAL_SECONDS", 20)
+POLL_TIMEOUT_SECONDS = CONFIG.get("POLL_TIMEOUT_SECONDS", 60)
+LOG_UPLOAD_TIMEOUT_SECONDS = CONFIG.get("LOG_UPLOAD_TIMEOUT_SECONDS", 300)
+MAINTENANCE_TIMEOUT_SECONDS = CONFIG.get("MAINTENANCE_TIMEOUT_SECONDS", 1800)
+DAILY_CHECK_SECONDS = 60
+UPDATE_CHECK_INTERVAL_SECONDS = 60 * 60  # 1 hour
+ARCHIVE_RETENTION_DAYS = CONFIG.get("ARCHIVE_RETENTION_DAYS", 90)
+ARCHIVE_DIR = CONFIG.get("ARCHIVE_DIR", "archive")
+TIMEZONE_OFFSET = CONFIG.get("TIMEZONE_OFFSET", -6)
+SQLITE_SYNCHRONOUS = CONFIG.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = CONFIG.get("SQLITE_BUSY_TIMEOUT_MS", 5000)
+
+def compact_events(db):
+    try:
+        moved = db.compact_events(ARCHIVE_RETENTION_DAYS, ARCHIVE_DIR)
+        logging.info(f"🗃️ Compaction done: {sum(moved.values())} events archived")
+    except Exception:
+        logging.exception("💥 Event compaction failed")
+
+def check_for_update(engine):
+    # 🔁 Check for firmware update
+    if 0    : #run_git_update():
+        logging.info("♻️ Restarting sync service after update...")
+        os.system("sudo systemctl restart webroster-bio-ui.service")
+        os.system("sudo systemctl restart webroster-sync.service")
+        engine.stop()  # Exit this instance after triggering restart
+
+def when_reachable(client, task):
+    # El circuit breaker de ADMS decide; mientras está abierto no se toca la red
+    def run():
+        if client.is_reachable():
+            return task()
+        logging.debug("🔌 ADMS circuit open, skipping this turn")
+        return SKIPPED
+    return run
+
+def build_engine(client, maintenance_db):
+    def maintenance():
+        # 🗃️ Daily archive of old synced events, online or not
+        compact_events(maintenance_db)
+
+    engine = SyncEngine([
+        SyncTask("push", when_reachable(client, client.push_pending_events), PUSH_INTERVAL_SECONDS,
+                 PUSH_TIMEOUT_SECONDS, priority=PRIORITY_REALTIME),
+        SyncTask("poll", when_reachable(client, client.poll_getrequest), POLL_INTERVAL_SECONDS,
+                 POLL_TIMEOUT_SECONDS, priority=PRIORITY_CONTROL),
+        SyncTask("log_upload", when_reachable(client, client.upload_latest_log), DAILY_CHECK_SECONDS,
+                 LOG_UPLOAD_TIMEOUT_SECONDS, daily=True),
+        SyncTask("maintenance", maintenance, DAILY_CHECK_SECONDS,
+                 MAINTENANCE_TIMEOUT_SECONDS, daily=True),
+        SyncTask("update_check", lambda: check_for_update(engine), UPDATE_CHECK_INTERVAL_SECONDS,
+                 MAINTENANCE_TIMEOUT_SECONDS),
+    ])
+    return engine
+
+async def run_engine(engine):
+    # 📨 Cada checada confirmada por la UI despierta el push sin esperar su intervalo
+    listener = SyncListener(lambda: engine.wake("push"))
+    listener.start(asyncio.get_running_loop())
+    try:
+        await engine.run()
+    finally:
+        listener.close()
 
 def main():
     logging.info("🔄 Sync service started.")        
-    manager = FingerprintManager(update_callback=log_status)
-    manager.send_handshake()
-
-    last_update_check = 0
-    update_interval = 60 * 60  # 1 hour
-    last_log_upload_date = None
-
-    while True:
-        try:
-            if is_online():
-                manager.poll_getrequest()
-                manager.push_unsynced_logs()
-
-                # 🔁 Check for firmware update
-                current_time = time.time()
-                if current_time - last_update_check > update_interval:
-                    last_update_check = current_time
-                    if 0    : #run_git_update():
-                        logging.info("♻️ Restarting sync service after update...")
-                        os.system("sudo systemctl restart webroster-bio-ui.service")
-                        os.system("sudo systemctl restart webroster-sync.service")
-                        return  # Exit this instance after triggering restart
-                today = datetime.now().date()
-                if last_log_upload_date != today:
-                    manager.upload_latest_log()
-                    last_log_upload_date = today
-            else:
-                logging.warning("🌐 No internet connection. Retrying in 20 seconds.")
-
-        except Exception as e:
-            logging.exception("💥 Sync loop error")
-
-        time.sleep(INTERVAL_SECONDS)
+    # Solo base local + cliente ADMS: el sensor y el audio son de la UI
+    db = LocalDB(synchronous=SQLITE_SYNCHRONOUS,
+                 busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                 utc_offset_hours=TIMEZONE_OFFSET)
+    client = ADMSClient(db, update_callback=log_status)
+    client.send_handshake()
+    client.release_in_flight_events()
+
+    # Conexión de escritura propia para archivo/vacuum: el push no espera su candado
+    maintenance_db = LocalDB(synchronous=SQLITE_SYNCHRONOUS,
+                             busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                             utc_offset_hours=TIMEZONE_OFFSET)
+
+    engine = build_engine(client, maintenance_db)
+    try:
+        asyncio.run(run_engine(engine))
+    finally:
+        client.transport.close()
+        maintenance_db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,24 @@
+# template_store.py
+#
+# Lista en memoria de las huellas que solo están en el host (no caben en la
+# librería del sensor). Los templates R30x vienen codificados por el módulo,
+# así que el host no puede compararlos: cada candidato se sube al char buffer
+# 2 y el sensor decide (compare_templates). Por eso el orden importa: la base
+# los entrega del agente que checó más recientemente al que lleva más tiempo
+# sin checar, que es quien con más probabilidad vuelve a poner el dedo.
+class HostTemplateIndex:
+    """rows → [(fingerprint_id, idagente, template), ...] como los da LocalDB.get_host_only_templates()."""
+
+    def __init__(self, rows=()):
+        rows = list(rows)
+        self.ids = [row[0] for row in rows]
+        self.agents = [row[1] for row in rows]
+        self.templates = [bytes(row[2]) for row in rows]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self, limit=None):
+        """Índices a verificar en orden; limit=None (o 0) recorre todos."""
+        count = len(self.ids)
+        return range(min(count, limit) if limit else count)
@@ -0,0 +1,184 @@
+# touch_detector.py
+#
+# Detección de dedo para el listener. Los lectores R30x/R503 exponen una
+# salida de "touch"/"wakeup" que cambia de nivel cuando hay un dedo encima;
+# si está cableada, el listener duerme hasta ese flanco en lugar de pedir
+# get_image() por UART cada 200 ms. Si no está cableada, se usa un sondeo
+# adaptivo que se relaja cuando no hay actividad.
+import abc
+import logging
+import threading
+import time
+
+
+class AdaptivePoller:
+    """Sin línea de touch: sondeo que se acelera tras actividad y se relaja en reposo."""
+
+    def __init__(self, min_interval=0.05, max_interval=0.4, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def wait_for_touch(self, timeout=None):
+        """Espera el intervalo actual; siempre indica que vale la pena intentar get_image()."""
+        delay = self.interval if timeout is None else min(self.interval, timeout)
+        time.sleep(delay)
+        return True
+
+    def notify_activity(self):
+        self.interval = self.min_interval
+
+    def notify_idle(self):
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def close(self):
+        pass
+
+
+class _LineTouchDetector(abc.ABC):
+    """Base para detectores con línea física: se despierta solo cuando la línea está activa."""
+
+    retry_interval = 0.05
+
+    def __init__(self, active_low=False):
+        self.active_low = active_low
+
+    @abc.abstractmethod
+    def is_touched(self):
+        """Nivel actual de la línea, ya corregido por active_low."""
+
+    @abc.abstractmethod
+    def wait_for_touch(self, timeout=None):
+        """Bloquea hasta que la línea indica dedo (True) o vence el timeout (False)."""
+
+    def notify_activity(self):
+        pass
+
+    def notify_idle(self):
+        # La línea decía "dedo" pero la imagen falló (dedo a medio colocar): reintento corto
+        time.sleep(self.retry_interval)
+
+    def close(self):
+        pass
+
+
+class GpioTouchDetector(_LineTouchDetector):
+    """Salida de touch del sensor conectada a un GPIO del Raspberry Pi (numeración BCM)."""
+
+    def __init__(self, pin, active_low=False):
+        super().__init__(active_low)
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+        self.pin = pin
+        self._touched = threading.Event()
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP if active_low else GPIO.PUD_DOWN)
+        edge = GPIO.FALLING if active_low else GPIO.RISING
+        GPIO.add_event_detect(pin, edge, callback=lambda _: self._touched.set(), bouncetime=20)
+
+    def is_touched(self):
+        level = self.GPIO.input(self.pin)
+        return level == (self.GPIO.LOW if self.active_low else self.GPIO.HIGH)
+
+    def wait_for_touch(self, timeout=None):
+        self._touched.clear()
+        if self.is_touched():
+            return True
+        return self._touched.wait(timeout)
+
+    def close(self):
+        try:
+            self.GPIO.remove_event_detect(self.pin)
+            self.GPIO.cleanup(self.pin)
+        except Exception:
+            pass
+
+
+class SerialTouchDetector(_LineTouchDetector):
+    """
+    Salida de touch cableada a una línea de módem del adaptador USB-UART
+    (CTS, DSR, RI o CD). Leerla es un ioctl local: no genera tráfico con el sensor.
+    """
+
+    LINES = ("cts", "dsr", "ri", "cd")
+
+    def __init__(self, uart, line="cts", active_low=False, poll_interval=0.01):
+        super().__init__(active_low)
+        if line not in self.LINES:
+            raise ValueError(f"Invalid serial touch line: {line}")
+        self.uart = uart
+        self.line = line
+        self.poll_interval = poll_interval
+
+    def is_touched(self):
+        return bool(getattr(self.uart, self.line)) != self.active_low
+
+    def wait_for_touch(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_touched():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+
+class RetouchWatch:
+    """
+    Avisa si el dedo se levantó y volvió a ponerse mientras el listener está
+    ocupado con otra cosa (p. ej. verificando templates del host). Con línea de
+    touch se lee la línea; sin ella se llama capture() cada probe_interval
+    (get_image solo escribe el ImageBuffer, no los char buffers).
+    """
+
+    def __init__(self, detector, capture=None, probe_interval=0.3):
+        self.is_touched = getattr(detector, "is_touched", None)
+        self.capture = capture
+        self.probe_interval = probe_interval
+        self._lifted = False
+        self._next_probe = time.monotonic() + probe_interval
+
+    def retouched(self):
+        if self.is_touched is not None:
+            touched = self.is_touched()
+        else:
+            now = time.monotonic()
+            if self.capture is None or now < self._next_probe:
+                return False
+            self._next_probe = now + self.probe_interval
+            touched = self.capture()
+
+        if not touched:
+            self._lifted = True
+            return False
+        return self._lifted
+
+
+def create_touch_detector(mode="auto", uart=None, gpio_pin=None, serial_line="cts",
+                          active_low=False, poll_min_interval=0.05, poll_max_interval=0.4):
+    """
+    mode → "gpio"   : flanco en gpio_pin
+           "serial" : línea de módem serial_line del puerto del sensor
+           "poll"   : sondeo adaptivo
+           "auto"   : gpio si hay pin configurado, si no sondeo adaptivo
+    Si el modo pedido no se puede inicializar se cae a sondeo adaptivo.
+    """
+    if mode == "auto":
+        mode = "gpio" if gpio_pin is not None else "poll"
+
+    try:
+        if mode == "gpio":
+            detector = GpioTouchDetector(int(gpio_pin), active_low=active_low)
+            logging.info(f"👆 Finger detection via GPIO{gpio_pin} edge")
+            return detector
+        if mode == "serial":
+            detector = SerialTouchDetector(uart, line=serial_line, active_low=active_low)
+            logging.info(f"👆 Finger detection via serial {serial_line.upper()} line")
+            return detector
+    except Exception:
+        logging.exception(f"⚠️ Touch detection mode '{mode}' unavailable, falling back to adaptive polling")
+
+    logging.info("👆 Finger detection via adaptive polling")
+    return AdaptivePoller(poll_min_interval, poll_max_interval)